@@ -0,0 +1,72 @@
+import numpy as np
+
+from rl_gym.agents.policy_gradient_agent import PolicyGradientAgent
+from rl_gym.environments.gym_like import VectorEnv
+from rl_gym.utils.returns import generalized_advantages
+
+class A2CAgent(PolicyGradientAgent):
+    '''
+    Synchronous advantage actor-critic: num_envs environments created by make_env() are stepped
+    together with one batched action sampling per step, and every rollout_length steps the actor
+    and critic are updated once on the whole (rollout_length * num_envs) batch, with GAE(lambda_)
+    advantages bootstrapped from the critic's values of the last states (n-step returns for lambda_ = 1).
+    The models are the ones of PolicyGradientAgent, an actor and a critic or an ActorCriticModel.
+    '''
+    def __init__(self, make_env, actor, critic=None, num_envs=8, rollout_length=5, gamma=0.99, lambda_=1.0, intra_op_threads=0, inter_op_threads=0, verbose=False):
+        super(A2CAgent, self).__init__(actor, critic, gamma=gamma, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads, verbose=verbose)
+        self.envs = VectorEnv(make_env, num_envs)
+        self.rollout_length = rollout_length
+        self.lambda_ = lambda_
+        self.states = None
+
+    def rollout_train(self):
+        # Runs rollout_length steps of all the environments and updates the models once, returns the steps taken
+        if self.states is None:
+            self.states = self.envs.reset()
+        n = len(self.envs)
+        T = self.rollout_length
+        states = np.empty((T, n, self.states.shape[1]), dtype=np.float32)
+        actions = np.empty((T, n), dtype=np.int32)
+        rewards = np.empty((T, n), dtype=np.float32)
+        dones = np.empty((T, n), dtype=bool)
+        for t in range(T):
+            states[t] = self.states
+            actions[t] = self.actor_model.sample_actions(self.states)[0]
+            self.states, rewards[t], dones[t] = self.envs.step(actions[t])
+
+        X = states.reshape(T * n, -1)
+        values = self.predict_values(np.concatenate([X, self.states]))
+        # a finished episode doesn't take the values of the next one
+        advantages, G = generalized_advantages(rewards, values[:T * n].reshape(T, n), dones, self.gamma, self.lambda_, values[T * n:])
+        self.fit(X, actions.reshape(-1), advantages.reshape(-1), G.reshape(-1))
+        return T * n
+
+    def train(self, num_episodes):
+        '''
+        Trains until num_episodes episodes are finished, returns their steps and returns.
+        '''
+        steps = []
+        returns = []
+        while len(returns) < num_episodes:
+            self.rollout_train()
+            for episode_steps, episode_return, _ in self.envs.finished_episodes:
+                steps.append(episode_steps)
+                returns.append(episode_return)
+            self.envs.finished_episodes = []
+            self.epoch += 1
+        return steps, returns
+
+    '''
+    Interface method
+    '''
+    def single_episode_train(self, env):
+        # The agent steps its own environments, env isn't used. Trains until an episode is finished
+        # and reports the first one.
+        while len(self.envs.finished_episodes) == 0:
+            self.rollout_train()
+            self.epoch += 1
+        return self.envs.finished_episodes.pop(0)
+
+    def close(self):
+        self.envs.close()
+        super(A2CAgent, self).close()
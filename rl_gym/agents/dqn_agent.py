@@ -1,13 +1,76 @@
 import sys
 import timeit
+import threading
 import numpy as np
 import tensorflow as tf
+from multiprocessing import Queue, Event
+import queue
+from queue import Empty, Full
 
-from rl_gym.models.tf_layers import HiddenLayer
+from rl_gym.models.tf_layers import HiddenLayer, create_models_session
+from rl_gym.utils.threading.worker import Worker
+from rl_gym.utils.threading.prefetcher import BatchPrefetcher
+from rl_gym.models.replay_memory import ReplayMemory, PrioritizedReplayMemory, MemoryMappedReplayMemory, CompactReplayMemory, NStepWindow
+
+def numpy_q_values(weights, s):
+    # Forward pass of a DQNModel from its parameter values: tanh hidden layers and a linear output
+    Z = np.atleast_2d(s).astype(np.float32)
+    for i in range(0, len(weights), 2):
+        Z = Z.dot(weights[i]) + weights[i + 1]
+        if i < len(weights) - 2:
+            Z = np.tanh(Z)
+    return Z[0]
+
+def dqn_actor(make_env, weights_queue, transitions_queue, stop, eps, eps_decay, eps_min, seed):
+    '''
+    Actor process: runs epsilon-greedy episodes with the latest weights it got from the learner and
+    sends every finished episode as a list of (s, a, r, s2, done) transitions.
+    '''
+    # don't block the process exit on transitions the learner won't read anymore
+    transitions_queue.cancel_join_thread()
+    np.random.seed(seed)
+    env = make_env()
+    weights = None
+    while weights is None and not stop.is_set():
+        try:
+            weights = weights_queue.get(timeout=1.0)
+        except Empty:
+            pass
+    episodes = 0
+    while not stop.is_set():
+        s = env.reset()
+        done = False
+        transitions = []
+        while not done:
+            try:
+                weights = weights_queue.get_nowait()
+            except Empty:
+                pass
+            if np.random.rand() < eps:
+                a = env.action_space.sample()
+            else:
+                a = np.argmax(numpy_q_values(weights, s))
+            s2, r, done, _ = env.step(a)
+            transitions.append((s, a, r, s2, done))
+            s = s2
+        # the learner may have stopped reading, so don't block forever on a full queue
+        while not stop.is_set():
+            try:
+                transitions_queue.put(transitions, timeout=1.0)
+                break
+            except Full:
+                pass
+        episodes += 1
+        if eps > eps_min:
+            eps *= eps_decay
+    return episodes
 
 class DQNModel:
-    def __init__(self, D, K, hidden_layer_sizes, gamma, max_experiences=10000, min_experiences=100, batch_sz=32):
+    def __init__(self, D, K, hidden_layer_sizes, gamma, max_experiences=10000, min_experiences=100, batch_sz=32, prioritized=False, memory_file=None, n_steps=1, prefetch=0, compact=False, state_dtype=np.float32):
+        self.D = D
         self.K = K
+        # the graph the model is built in, the ops it adds later go there too
+        self.graph = tf.get_default_graph()
 
         # create the graph
         self.layers = []
@@ -30,93 +93,192 @@ class DQNModel:
         self.X = tf.placeholder(tf.float32, shape=(None, D), name='X')
         self.G = tf.placeholder(tf.float32, shape=(None,), name='G')
         self.actions = tf.placeholder(tf.int32, shape=(None,), name='actions')
+        # importance sampling weights of prioritized replay, all ones otherwise. The default is shaped
+        # after actions, which both training steps feed (G isn't fed when targets are computed in the graph)
+        self.weights = tf.placeholder_with_default(tf.ones_like(self.actions, dtype=tf.float32), shape=(None,), name='weights')
 
         # calculate output and cost
-        Z = self.X
-        for layer in self.layers:
-            Z = layer.forward(Z)
-        Y_hat = Z
+        Y_hat = self.forward(self.X)
         self.predict_op = Y_hat
 
         selected_action_values = tf.reduce_sum(
           Y_hat * tf.one_hot(self.actions, K),
           reduction_indices=[1]
         )
+        self.selected_action_values = selected_action_values
 
-        cost = tf.reduce_sum(tf.square(self.G - selected_action_values))
+        self.td_error = self.G - selected_action_values
+        cost = tf.reduce_sum(self.weights * tf.square(self.td_error))
         self.train_op = tf.train.AdamOptimizer(10e-3).minimize(cost)
         # self.train_op = tf.train.AdagradOptimizer(10e-3).minimize(cost)
         # self.train_op = tf.train.MomentumOptimizer(10e-4, momentum=0.9).minimize(cost)
         # self.train_op = tf.train.GradientDescentOptimizer(10e-5).minimize(cost)
 
-        # create replay memory
-        self.experience = {'s': [], 'a': [], 'r': [], 's2': [], 'done': []}
+        # create replay memory, a compact one stores every observation once as state_dtype
+        # and builds n-step transitions when they are sampled
+        self.prioritized = prioritized
+        self.compact = compact
+        if prioritized and memory_file != None:
+            raise RuntimeError("Prioritized replay can't be stored in a memory file")
+        elif compact and (prioritized or memory_file != None):
+            raise RuntimeError("Compact replay can't be prioritized or stored in a memory file")
+        elif prioritized:
+            self.memory = PrioritizedReplayMemory(max_experiences, (D,), state_dtype)
+        elif memory_file != None:
+            self.memory = MemoryMappedReplayMemory(memory_file, max_experiences, (D,), state_dtype)
+        elif compact:
+            self.memory = CompactReplayMemory(max_experiences, (D,), gamma, n_steps, state_dtype)
+        else:
+            self.memory = ReplayMemory(max_experiences, (D,), state_dtype)
         self.max_experiences = max_experiences
         self.min_experiences = min_experiences
         self.batch_sz = batch_sz
         self.gamma = gamma
+        # transitions are stored as n-step returns, bootstrapped with gamma^n * max Q(s_t+n)
+        self.n_steps = n_steps
+        self.window = NStepWindow(n_steps, gamma)
+        self.target_network = None
+        self.sync_source = None
+        # guards the replay memory when a learner thread trains while experiences are added
+        self.lock = threading.Lock()
+        # number of minibatches sampled ahead by a background thread, 0 samples them in train()
+        self.prefetch = prefetch
+        self.prefetcher = None
+
+    def forward(self, X):
+        Z = X
+        for layer in self.layers:
+            Z = layer.forward(Z)
+        return Z
+
+    def set_target_network(self, target_network, double_dqn=False):
+        # Wire the target network forward pass, done masking and (for Double DQN) the greedy action
+        # of this network into a training step, so an update is a single session.run
+        self.target_network = target_network
+        with self.graph.as_default():
+            self.next_X = tf.placeholder(tf.float32, shape=(None, self.D), name='next_X')
+            self.rewards = tf.placeholder(tf.float32, shape=(None,), name='rewards')
+            self.dones = tf.placeholder(tf.float32, shape=(None,), name='dones')
+            self.discounts = tf.placeholder(tf.float32, shape=(None,), name='discounts')
+
+            next_Q = target_network.forward(self.next_X)
+            if double_dqn:
+                next_actions = tf.argmax(self.forward(self.next_X), axis=1)
+                next_q = tf.reduce_sum(next_Q * tf.one_hot(next_actions, self.K), reduction_indices=[1])
+            else:
+                next_q = tf.reduce_max(next_Q, reduction_indices=[1])
+            targets = tf.stop_gradient(self.rewards + self.discounts * (1.0 - self.dones) * next_q)
+
+            self.target_td_error = targets - self.selected_action_values
+            cost = tf.reduce_sum(self.weights * tf.square(self.target_td_error))
+            self.target_train_op = tf.train.AdamOptimizer(10e-3).minimize(cost, var_list=self.params)
 
     def set_session(self, session):
         self.session = session
 
+    def build_sync_ops(self, other, tau=0.01):
+        # Assign ops are created once and run in place, creating them on every copy grows the graph
+        self.sync_source = other
+        with self.graph.as_default():
+            self.copy_op = tf.group(*[p.assign(q) for p, q in zip(self.params, other.params)])
+            # Polyak averaging: p = tau * q + (1 - tau) * p
+            self.soft_update_op = tf.group(*[p.assign(tau * q + (1 - tau) * p) for p, q in zip(self.params, other.params)])
+
     def copy_from(self, other):
-        # collect all the ops
-        ops = []
-        my_params = self.params
-        other_params = other.params
-        for p, q in zip(my_params, other_params):
-            actual = self.session.run(q)
-            op = p.assign(actual)
-            ops.append(op)
-        # now run them all
-        self.session.run(ops)
+        if self.sync_source is not other:
+            self.build_sync_ops(other)
+        self.session.run(self.copy_op)
+
+    def soft_update_from(self, other):
+        if self.sync_source is not other:
+            self.build_sync_ops(other)
+        self.session.run(self.soft_update_op)
 
     def predict(self, X):
         X = np.atleast_2d(X)
         return self.session.run(self.predict_op, feed_dict={self.X: X})
 
+    def sample_batch(self):
+        # randomly select a batch, as the arrays fed to the graph
+        with self.lock:
+            idx = self.memory.sample_indices(self.batch_sz)
+            states, actions, rewards, next_states, dones, discounts = self.memory.batch(idx)
+            weights = self.memory.importance_weights(idx) if self.prioritized else None
+        states, next_states = states.astype(np.float32, copy=False), next_states.astype(np.float32, copy=False)
+        return idx, states, actions, rewards, next_states, dones.astype(np.float32), discounts, weights
+
+    def stop_prefetch(self):
+        if self.prefetcher != None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
     def train(self, target_network):
         # sample a random batch from buffer, do an iteration of GD
-        if len(self.experience['s']) < self.min_experiences:
+        if len(self.memory) < self.min_experiences:
             # don't do anything if we don't have enough experience
-            return
-
-        # randomly select a batch
-        idx = np.random.choice(len(self.experience['s']), size=self.batch_sz, replace=False)
-        # print("idx:", idx)
-        states = [self.experience['s'][i] for i in idx]
-        actions = [self.experience['a'][i] for i in idx]
-        rewards = [self.experience['r'][i] for i in idx]
-        next_states = [self.experience['s2'][i] for i in idx]
-        dones = [self.experience['done'][i] for i in idx]
-        next_Q = np.max(target_network.predict(next_states), axis=1)
-        targets = [r + self.gamma*next_q if not done else r for r, next_q, done in zip(rewards, next_Q, dones)]
+            return False
+
+        if self.prefetch > 0:
+            # batches are drawn from the memory as it was a few updates ago,
+            # with prioritized replay their priorities can be a few updates old as well
+            if self.prefetcher == None:
+                self.prefetcher = BatchPrefetcher(self.sample_batch, self.prefetch, name="dqn_prefetcher")
+                self.prefetcher.start()
+            try:
+                batch = self.prefetcher.next()
+            except Exception:
+                # the failed prefetcher is dropped, a later call starts a new one
+                self.stop_prefetch()
+                raise
+            idx, states, actions, rewards, next_states, dones, discounts, weights = batch
+        else:
+            idx, states, actions, rewards, next_states, dones, discounts, weights = self.sample_batch()
+        if target_network is self.target_network:
+            # targets are computed in the graph
+            train_op, td_error = self.target_train_op, self.target_td_error
+            feed_dict = {
+                self.X: states,
+                self.actions: actions,
+                self.next_X: next_states,
+                self.rewards: rewards,
+                self.dones: dones,
+                self.discounts: discounts
+            }
+        else:
+            next_Q = np.max(target_network.predict(next_states), axis=1)
+            targets = rewards + discounts * next_Q * (1 - dones)
+            train_op, td_error = self.train_op, self.td_error
+            feed_dict = {
+                self.X: states,
+                self.G: targets,
+                self.actions: actions
+            }
 
         # call optimizer
-        self.session.run(
-          self.train_op,
-          feed_dict={
-            self.X: states,
-            self.G: targets,
-            self.actions: actions
-          }
-        )
+        if self.prioritized:
+            feed_dict[self.weights] = weights
+            _, td_errors = self.session.run([train_op, td_error], feed_dict=feed_dict)
+            with self.lock:
+                self.memory.update_priorities(idx, td_errors)
+        else:
+            self.session.run(train_op, feed_dict=feed_dict)
+        return True
 
     def add_experience(self, s, a, r, s2, done):
-        if len(self.experience['s']) >= self.max_experiences:
-            self.experience['s'].pop(0)
-            self.experience['a'].pop(0)
-            self.experience['r'].pop(0)
-            self.experience['s2'].pop(0)
-            self.experience['done'].pop(0)
-        self.experience['s'].append(s)
-        self.experience['a'].append(a)
-        self.experience['r'].append(r)
-        self.experience['s2'].append(s2)
-        self.experience['done'].append(done)
+        # experiences must come in episode order, each one completes at most one n-step transition
+        # (all the pending ones at the end of the episode)
+        with self.lock:
+            if self.compact:
+                self.memory.add(s, a, r, s2, done)
+                return
+            for transition in self.window.append(s, a, r, s2, done):
+                self.memory.add(*transition)
+
+    def get_weights(self):
+        return self.session.run(self.params)
 
 class DQNAgent(object):
-    def __init__(self, model, target_model, eps=1.0, eps_decay = 0.99, eps_min=0, gamma=0.9, copy_period = 50, verbose=False):
+    def __init__(self, model, target_model, eps=1.0, eps_decay = 0.99, eps_min=0, gamma=0.9, copy_period = 50, double_dqn=False, tau=None, pipelined=False, weights_period=10, updates_per_step=1, intra_op_threads=0, inter_op_threads=0, verbose=False):
         self.model = model
         self.target_model = target_model
         self.eps = eps
@@ -124,16 +286,29 @@ class DQNAgent(object):
         self.eps_decay = eps_decay
         self.eps_min = eps_min
         self.copy_period = copy_period
+        # soft target updates after every step if set, hard copies every copy_period steps otherwise
+        self.tau = tau
+        # in pipelined mode a learner thread trains while episodes act on a weights snapshot
+        # refreshed every weights_period steps, every environment step allows updates_per_step updates
+        self.pipelined = pipelined
+        self.weights_period = weights_period
+        self.updates_per_step = updates_per_step
+        self.learner = None
+        self.learner_stop = threading.Event()
+        self.learner_steps = None
+        self.learner_error = None
+        self.updates = 0
         self.random_actions = 0
         self.greedy_actions = 0
         self.epoch = 0
         self.verbose = verbose
 
-        init = tf.global_variables_initializer()
-        self.session = tf.InteractiveSession()
-        self.session.run(init)
-        model.set_session(self.session)
-        target_model.set_session(self.session)
+        # the training step and sync ops connect both models, so they need one graph from the start
+        if model.graph is not target_model.graph:
+            raise RuntimeError("Model and target model must be built in the same graph")
+        model.set_target_network(target_model, double_dqn)
+        target_model.build_sync_ops(model, tau if tau != None else 0.01)
+        self.graph, self.session = create_models_session([model, target_model], intra_op_threads, inter_op_threads)
 
     def choose_action(self, env, s, y_s):
         # choose an action based on epsilon-greedy strategy
@@ -153,10 +328,83 @@ class DQNAgent(object):
 
         return next_move
 
+    def learner_loop(self):
+        while not self.learner_stop.is_set():
+            # one update per item put by an environment step, so the learner doesn't run ahead of the data
+            try:
+                self.learner_steps.get(timeout=0.01)
+            except Empty:
+                continue
+            try:
+                # session.run releases the GIL, so environment steps go on in the main thread meanwhile
+                if self.learner_error == None and self.model.train(self.target_model):
+                    self.updates += 1
+                    if self.tau != None:
+                        self.target_model.soft_update_from(self.model)
+                    elif self.updates % self.copy_period == 0:
+                        self.target_model.copy_from(self.model)
+            except Exception as e:
+                # passed on by stop_learner(), the remaining updates are skipped
+                self.learner_error = e
+            finally:
+                self.learner_steps.task_done()
+
+    def start_learner(self):
+        if self.learner == None:
+            self.learner_stop.clear()
+            self.learner_steps = queue.Queue()
+            self.learner_error = None
+            self.learner = threading.Thread(target=self.learner_loop, name="dqn_learner")
+            self.learner.daemon = True
+            self.learner.start()
+
+    def stop_learner(self):
+        if self.learner != None:
+            self.learner_stop.set()
+            self.learner.join()
+            self.learner = None
+            error, self.learner_error = self.learner_error, None
+            if error != None:
+                raise error
+
+    def pipelined_episode_train(self, env):
+        self.start_learner()
+        steps = 0
+        done = False
+        s = env.reset()
+        total_return = 0
+        while not done:
+            if steps % self.weights_period == 0:
+                weights = self.model.get_weights()
+            y_s = numpy_q_values(weights, s)
+            a = self.choose_action(env, s, y_s)
+            s2, r, done, _ = env.step(a)
+            total_return += r
+            self.model.add_experience(s, a, r, s2, done)
+            for _ in range(self.updates_per_step):
+                self.learner_steps.put(True)
+            steps += 1
+            s = s2
+
+        # let the learner finish the updates of this episode and pause it, the weights stay put
+        # between episodes and while the agent is evaluated
+        self.learner_steps.join()
+        self.stop_learner()
+
+        self.epoch += 1
+        if self.eps > self.eps_min:
+            self.eps *= self.eps_decay
+        if self.tau == None:
+            self.target_model.copy_from(self.model)
+        self.model.memory.flush()
+        return steps, total_return, r
+
     '''
     Interface method
     '''
     def single_episode_train(self, env):
+        if self.pipelined:
+            return self.pipelined_episode_train(env)
         steps = 0
         done = False
         s = env.reset()
@@ -182,7 +430,9 @@ class DQNAgent(object):
             steps += 1
             s = s2
 
-            if steps % self.copy_period == 0:
+            if self.tau != None:
+                self.target_model.soft_update_from(self.model)
+            elif steps % self.copy_period == 0:
                 self.target_model.copy_from(self.model)
 
         self.epoch += 1
@@ -192,13 +442,94 @@ class DQNAgent(object):
             print("Actions sequence for this episode:")
             print(actions)
 
-        self.target_model.copy_from(self.model)
+        if self.tau == None:
+            self.target_model.copy_from(self.model)
+        self.model.memory.flush()
 
         return steps, total_return, r
 
+    def actor_learner_train(self, make_env, num_episodes, num_actors=4, weights_period=100):
+        '''
+        Actor-learner mode: num_actors processes created by make_env() collect episodes with the
+        weights they last got and stream them into the replay memory, while this process only trains.
+        Actors get fresh weights every weights_period updates. Returns steps and returns of the episodes.
+        '''
+        stop = Event()
+        transitions_queue = Queue(maxsize=10 * num_actors)
+        weights_queues = [Queue(1) for _ in range(num_actors)]
+        seeds = np.random.randint(2 ** 31 - 1, size=num_actors)
+        actors = []
+        for i in range(num_actors):
+            args = (make_env, weights_queues[i], transitions_queue, stop, self.eps, self.eps_decay, self.eps_min, seeds[i])
+            actors.append(Worker(dqn_actor, args=args, name=("actor%d" % i)))
+            actors[i].start()
+
+        returns = []
+        steps = 0
+        updates = 0
+        try:
+            self.send_weights(weights_queues)
+            while len(returns) < num_episodes:
+                # keep training on the memory while the actors are stepping, wait only if it's too small
+                block = len(self.model.memory) < self.model.min_experiences
+                while True:
+                    try:
+                        transitions = transitions_queue.get(block=block, timeout=1.0)
+                    except Empty:
+                        break
+                    block = False
+                    for s, a, r, s2, done in transitions:
+                        self.model.add_experience(s, a, r, s2, done)
+                    steps += len(transitions)
+                    returns.append(sum(t[2] for t in transitions))
+                    self.epoch += 1
+                    if self.eps > self.eps_min:
+                        self.eps *= self.eps_decay
+
+                if self.model.train(self.target_model):
+                    updates += 1
+                    if self.tau != None:
+                        self.target_model.soft_update_from(self.model)
+                    elif updates % self.copy_period == 0:
+                        self.target_model.copy_from(self.model)
+                    if updates % weights_period == 0:
+                        self.send_weights(weights_queues)
+        finally:
+            stop.set()
+            for actor in actors:
+                actor.join()
+            # weights larger than the pipe buffer may still be half written by the feeder thread of a queue
+            # nobody reads anymore, don't let it block the exit
+            for q in weights_queues:
+                q.cancel_join_thread()
+                q.close()
+
+        if self.tau == None:
+            self.target_model.copy_from(self.model)
+        self.model.memory.flush()
+        return steps, returns
+
+    def send_weights(self, weights_queues):
+        weights = self.model.get_weights()
+        for q in weights_queues:
+            # replace weights the actor didn't pick up yet
+            try:
+                q.get_nowait()
+            except Empty:
+                pass
+            try:
+                q.put_nowait(weights)
+            except Full:
+                pass
+
     '''
     Interface method
     '''
     def optimal_action(self, s, action_space):
         y = self.target_model.predict(s).squeeze()
-        return np.argmax(y)
\ No newline at end of file
+        return np.argmax(y)
+
+    def close(self):
+        self.stop_learner()
+        self.model.stop_prefetch()
+        self.session.close()
\ No newline at end of file
@@ -0,0 +1,52 @@
+import numpy as np
+
+from rl_gym.agents.qlearning_agent import QLearningTabularAgent
+from rl_gym.environments.grid_world import REWARD_HANG
+from rl_gym.models.tabular_models import QTable, td_update
+
+class DynaQTabularAgent(QLearningTabularAgent):
+    '''
+    Dyna-Q: every real step also records (s, a) -> (s2, r, done) in a tabular model of the world and
+    runs planning_steps Q-learning updates on transitions replayed from previously seen pairs.
+    Grid worlds are deterministic, so the latest observation of a pair is its model.
+    '''
+    def __init__(self, num_states, num_actions, planning_steps=10, eps=1.0, eps_decay = 0.99, eps_min=0.05, gamma=0.9, alpha=0.1, env_descriptor = None, verbose=False):
+        super(DynaQTabularAgent, self).__init__(eps=eps, eps_decay=eps_decay, eps_min=eps_min, gamma=gamma, alpha=alpha, env_descriptor=env_descriptor, verbose=verbose)
+        self.planning_steps = planning_steps
+        self.num_actions = num_actions
+        self.Q = QTable(num_states, num_actions)
+        self.update_counts_sa = QTable(num_states, num_actions, fill=1.0)
+
+        # learned model indexed by s * num_actions + a
+        self.model_s2 = np.full(num_states * num_actions, -1, dtype=np.int64)
+        self.model_r = np.zeros(num_states * num_actions)
+        self.model_done = np.zeros(num_states * num_actions, dtype=bool)
+        # pairs seen so far, to sample planning updates from
+        self.seen_pairs = np.empty(num_states * num_actions, dtype=np.int64)
+        self.num_seen = 0
+
+    def record(self, s, a, s2, r, done):
+        # Running out of steps is not a property of (s, a), don't teach it to the model
+        if r == REWARD_HANG:
+            return
+        sa = s * self.num_actions + a
+        if self.model_s2[sa] < 0:
+            self.seen_pairs[self.num_seen] = sa
+            self.num_seen += 1
+        self.model_s2[sa] = s2
+        self.model_r[sa] = r
+        self.model_done[sa] = done
+
+    def plan(self):
+        if self.num_seen == 0 or self.planning_steps == 0:
+            return
+        sa = self.seen_pairs[np.random.randint(self.num_seen, size=self.planning_steps)]
+        s2 = self.model_s2[sa]
+        targets = self.model_r[sa] + self.gamma * self.Q.values[s2].max(axis=1) * ~self.model_done[sa]
+        td_update(self.Q, self.update_counts_sa, sa // self.num_actions, sa % self.num_actions, targets, self.alpha)
+
+    def learn(self, s, a, r, s2, done):
+        # direct RL update followed by planning on the learned model
+        super(DynaQTabularAgent, self).learn(s, a, r, s2, done)
+        self.record(s, a, s2, r, done)
+        self.plan()
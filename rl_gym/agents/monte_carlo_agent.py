@@ -8,6 +8,9 @@ import sys
 import timeit
 import numpy as np
 
+from rl_gym.models.tabular_models import save_q_tables, load_q_tables
+from rl_gym.utils.returns import discounted_returns
+
 class MonteCarloTabularAgent(object):
     def __init__(self, eps=1.0, eps_decay = 0.99, eps_min=0.05, gamma=0.9, env_descriptor = None, verbose=False):
         self.eps = eps
@@ -83,11 +86,9 @@ class MonteCarloTabularAgent(object):
         env.show_policy(self.policy)
         pass
     
-    def load_model(self, file_name):
-#         model = np.fromfile(file_name)
-#         self.V = model.reshape(2, int(model.size / 2))[0]
-#         self.policy = model.reshape(2, int(model.size / 2))[1]
-        pass
+    def load_model(self, file_name, mode='c'):
+        # Only the action values are stored, returns observed later start new averages
+        self.Q, _, self.policy = load_q_tables(file_name, mode)
 
     def print_Q(self, Q):
         for s in Q:
@@ -96,29 +97,19 @@ class MonteCarloTabularAgent(object):
     '''
     Interface method
     '''    
-    def save_model(self, file_name):
-#         model = np.concatenate((self.V.reshape(1, self.V.size), self.policy.reshape(1, self.policy.size)))
-#         model.tofile(file_name)
-        pass
+    def save_model(self, file_name, num_states=None, num_actions=None):
+        save_q_tables(file_name, self.Q, num_states=num_states, num_actions=num_actions, env_descriptor=self.env_descriptor)
     
     def single_episode_train(self, env):
         states_actions_rewards, steps = self.single_episode_exploration(env)
 #                 print(states_actions_rewards)
-        # calculate the returns by working backwards from the terminal state
-        G = 0
+        # calculate the returns of the whole episode at once, the reward of an entry is the one
+        # received when entering its state, so the return of a move starts at the next entry
+        # the terminal state has no move and its value is 0 by definition
         total_return = 0
-        states_actions_returns = []
-        first = True
-        for s, a, r in reversed(states_actions_rewards):
-            # the value of the terminal state is 0 by definition
-            # we should ignore the first state we encounter
-            # and ignore the last G, which is meaningless since it doesn't correspond to any move
-            if first:
-                first = False
-            else:
-                states_actions_returns.append((s, a, G))
-            G = r + self.gamma * G
-        states_actions_returns.reverse()  # we want it to be in order of state visited
+        rewards = np.array([r for _, _, r in states_actions_rewards], dtype=np.float64)
+        returns = discounted_returns(rewards[1:], np.zeros(len(rewards) - 1, dtype=bool), self.gamma)
+        states_actions_returns = [(s, a, G) for (s, a, _), G in zip(states_actions_rewards[:-1], returns)]
 #                 print(states_actions_returns)
         # calculate Q(s,a)
         seen_state_action_pairs = set()
@@ -3,11 +3,20 @@ import timeit
 import numpy as np
 import tensorflow as tf
 
-from rl_gym.models.tf_layers import HiddenLayer
+from rl_gym.models.tf_layers import HiddenLayer, create_models_session
+from rl_gym.utils.returns import generalized_advantages
+
+def sampling_ops(p_a_given_s, K):
+    # One categorical sample per row of action probabilities and its log probability, drawn in the
+    # graph so they come with the probabilities from the same session.run
+    actions = tf.to_int32(tf.reshape(tf.multinomial(tf.log(p_a_given_s), 1), [-1]))
+    log_probs = tf.log(tf.reduce_sum(p_a_given_s * tf.one_hot(actions, K), reduction_indices=[1]))
+    return actions, log_probs
 
 # approximates pi(a | s)
 class PolicyModel:
     def __init__(self, D, K, hidden_layer_sizes, lr=10e-2):
+        self.graph = tf.get_default_graph()
         # create the graph
         # K = number of actions
         self.layers = []
@@ -36,6 +45,7 @@ class PolicyModel:
         # p_a_given_s = tf.nn.softmax(action_scores)
         # self.action_scores = action_scores
         self.predict_op = p_a_given_s
+        self.sample_op, self.log_prob_op = sampling_ops(p_a_given_s, K)
 
         # self.one_hot_actions = tf.one_hot(self.actions, K)
 
@@ -62,9 +72,10 @@ class PolicyModel:
         self.session = session
 
     def partial_fit(self, X, actions, advantages):
-        X = np.atleast_2d(X)
-        actions = np.atleast_1d(actions)
-        advantages = np.atleast_1d(advantages)
+        # contiguous arrays of the placeholders' dtypes are fed without another conversion
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        actions = np.atleast_1d(np.asarray(actions, dtype=np.int32))
+        advantages = np.asarray(advantages, dtype=np.float32).reshape(-1)
         self.session.run(
           self.train_op,
           feed_dict={
@@ -78,14 +89,19 @@ class PolicyModel:
         X = np.atleast_2d(X)
         return self.session.run(self.predict_op, feed_dict={self.X: X})
 
+    def sample_actions(self, X):
+        # batched variant of sample_action, returns actions, probabilities and log probabilities of the actions
+        X = np.atleast_2d(X)
+        return self.session.run([self.sample_op, self.predict_op, self.log_prob_op], feed_dict={self.X: X})
+
     def sample_action(self, X):
-        p = self.predict(X)[0]
-        return np.random.choice(len(p), p=p)
+        return self.sample_actions(X)[0][0]
 
 
 # approximates V(s)
 class ValueModel:
     def __init__(self, D, hidden_layer_sizes, lr=10e-5):
+        self.graph = tf.get_default_graph()
         # create the graph
         self.layers = []
         M1 = D
@@ -116,51 +132,236 @@ class ValueModel:
         self.session = session
 
     def partial_fit(self, X, Y):
-        X = np.atleast_2d(X)
-        Y = np.atleast_1d(Y)
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        Y = np.asarray(Y, dtype=np.float32).reshape(-1)
         self.session.run(self.train_op, feed_dict={self.X: X, self.Y: Y})
 
     def predict(self, X):
         X = np.atleast_2d(X)
         return self.session.run(self.predict_op, feed_dict={self.X: X})
 
+# approximates pi(a | s) and V(s) with one network
+class ActorCriticModel:
+    '''
+    Policy and value heads on top of hidden layers shared by both, so a single forward pass gives
+    pi(a | s) and V(s) and a single optimizer step trains both heads. With no shared layers the heads
+    are separate networks that are still evaluated and trained together.
+    '''
+    def __init__(self, D, K, hidden_layer_sizes, actor_layer_sizes=[], critic_layer_sizes=[], lr=10e-3, value_coef=0.5):
+        self.graph = tf.get_default_graph()
+        # create the graph
+        self.layers = []
+        M1 = D
+        for M2 in hidden_layer_sizes:
+            layer = HiddenLayer(M1, M2)
+            self.layers.append(layer)
+            M1 = M2
+        M_shared = M1
+
+        self.actor_layers = []
+        for M2 in actor_layer_sizes:
+            self.actor_layers.append(HiddenLayer(M1, M2))
+            M1 = M2
+        self.actor_layers.append(HiddenLayer(M1, K, tf.nn.softmax, use_bias=False))
+
+        M1 = M_shared
+        self.critic_layers = []
+        for M2 in critic_layer_sizes:
+            self.critic_layers.append(HiddenLayer(M1, M2))
+            M1 = M2
+        self.critic_layers.append(HiddenLayer(M1, 1, lambda x: x))
+
+        # inputs and targets
+        self.X = tf.placeholder(tf.float32, shape=(None, D), name='X')
+        self.actions = tf.placeholder(tf.int32, shape=(None,), name='actions')
+        self.advantages = tf.placeholder(tf.float32, shape=(None,), name='advantages')
+        self.Y = tf.placeholder(tf.float32, shape=(None,), name='Y')
+
+        # calculate outputs and cost
+        Z = self.X
+        for layer in self.layers:
+            Z = layer.forward(Z)
+        p_a_given_s = Z
+        for layer in self.actor_layers:
+            p_a_given_s = layer.forward(p_a_given_s)
+        V = Z
+        for layer in self.critic_layers:
+            V = layer.forward(V)
+        self.predict_op = p_a_given_s
+        self.value_op = tf.reshape(V, [-1])
+        self.sample_op, self.log_prob_op = sampling_ops(p_a_given_s, K)
+
+        selected_probs = tf.log(
+          tf.reduce_sum(
+            p_a_given_s * tf.one_hot(self.actions, K),
+            reduction_indices=[1]
+          )
+        )
+        actor_cost = -tf.reduce_sum(self.advantages * selected_probs)
+        critic_cost = tf.reduce_sum(tf.square(self.Y - self.value_op))
+        cost = actor_cost + value_coef * critic_cost
+        optimizer = tf.train.AdagradOptimizer(learning_rate=lr)
+
+        gvs = optimizer.compute_gradients(cost)
+        capped_gvs = [(tf.clip_by_average_norm(grad, 1.0), var) for grad, var in gvs]
+        self.train_op = optimizer.apply_gradients(capped_gvs)
+
+    def set_session(self, session):
+        self.session = session
+
+    def partial_fit(self, X, actions, advantages, Y):
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        actions = np.atleast_1d(np.asarray(actions, dtype=np.int32))
+        advantages = np.asarray(advantages, dtype=np.float32).reshape(-1)
+        Y = np.asarray(Y, dtype=np.float32).reshape(-1)
+        self.session.run(
+          self.train_op,
+          feed_dict={
+            self.X: X,
+            self.actions: actions,
+            self.advantages: advantages,
+            self.Y: Y,
+          }
+        )
+
+    def predict(self, X):
+        X = np.atleast_2d(X)
+        return self.session.run(self.predict_op, feed_dict={self.X: X})
+
+    def predict_value(self, X):
+        X = np.atleast_2d(X)
+        return self.session.run(self.value_op, feed_dict={self.X: X})
+
+    def evaluate(self, X):
+        # sampled actions and state values from one forward pass
+        X = np.atleast_2d(X)
+        return self.session.run([self.sample_op, self.value_op], feed_dict={self.X: X})
+
+    def sample_actions(self, X):
+        # batched variant of sample_action, returns actions, probabilities and log probabilities of the actions
+        X = np.atleast_2d(X)
+        return self.session.run([self.sample_op, self.predict_op, self.log_prob_op], feed_dict={self.X: X})
+
+    def sample_action(self, X):
+        return self.sample_actions(X)[0][0]
+
 class PolicyGradientAgent(object):
-    def __init__(self, actor, critic, eps=1.0, eps_decay = 0.99, eps_min=0, gamma=0.9, verbose=False):
+    def __init__(self, actor, critic=None, eps=1.0, eps_decay = 0.99, eps_min=0, gamma=0.9, batch_updates=False, rollout_length=None, lambda_=0.0, intra_op_threads=0, inter_op_threads=0, verbose=False):
         self.actor_model = actor
         self.critic_model = critic
         self.eps = eps
         self.gamma = gamma
         self.eps_decay = eps_decay
         self.eps_min = eps_min
+        # with batch updates the models are trained once per rollout_length steps (per episode if None)
+        # instead of after every step, on GAE(lambda_) advantages (one step TD errors for lambda_ = 0)
+        self.batch_updates = batch_updates
+        self.rollout_length = rollout_length
+        self.lambda_ = lambda_
+        # without a critic the actor is an ActorCriticModel predicting the values as well
+        self.shared = critic == None
         self.random_actions = 0
         self.greedy_actions = 0
         self.epoch = 0
         self.verbose = verbose
 
-        init = tf.global_variables_initializer()
-        self.session = tf.InteractiveSession()
-        self.session.run(init)
-        actor.set_session(self.session)
-        critic.set_session(self.session)
+        self.graph, self.session = create_models_session([actor] if self.shared else [actor, critic], intra_op_threads, inter_op_threads)
+
+    def predict_values(self, X):
+        if self.shared:
+            return self.actor_model.predict_value(X)
+        return self.critic_model.predict(X)
+
+    def fit(self, X, actions, advantages, G):
+        if self.shared:
+            self.actor_model.partial_fit(X, actions, advantages, G)
+        else:
+            self.actor_model.partial_fit(X, actions, advantages)
+            self.critic_model.partial_fit(X, G)
+
+    def update_batch(self, states, actions, rewards, next_states, dones):
+        # Targets and advantages of the whole rollout, from a single critic prediction.
+        # A rollout doesn't cross episodes, so every next state but the last one is the following state
+        n = len(rewards)
+        X = np.array(states, dtype=np.float32).reshape(n, -1)
+        X2 = np.array(next_states[-1:], dtype=np.float32).reshape(1, -1)
+        values = self.predict_values(np.concatenate([X, X2]))
+        advantages, G = generalized_advantages(rewards, values[:n], dones, self.gamma, self.lambda_, values[n])
+        self.fit(X, actions, advantages, G)
+
+    def shared_episode_train(self, env):
+        # Per step updates with an ActorCriticModel: the forward pass of s2 gives both its value
+        # for the target of s and the action of the next step
+        steps = 0
+        done = False
+        s = env.reset()
+        total_return = 0
+        actions, v = self.actor_model.evaluate(s)
+        while not done:
+            a = actions[0]
+            s2, r, done, _ = env.step(a)
+            total_return += r
+
+            if not done:
+                actions, v2 = self.actor_model.evaluate(s2)
+                G = r + self.gamma * v2
+            else:
+                G = np.array([r])
+            self.actor_model.partial_fit(s, a, G - v, G)
+
+            steps += 1
+            s = s2
+            if not done:
+                v = v2
+
+        self.epoch += 1
+        return steps, total_return, r
+
+    def batched_episode_train(self, env):
+        steps = 0
+        done = False
+        s = env.reset()
+        total_return = 0
+        states, actions, rewards, next_states, dones = [], [], [], [], []
+        while not done:
+            a = self.actor_model.sample_action(s)
+            s2, r, done, _ = env.step(a)
+            total_return += r
+            states.append(s)
+            actions.append(a)
+            rewards.append(r)
+            next_states.append(s2)
+            dones.append(done)
+
+            steps += 1
+            s = s2
+            if done or len(rewards) == self.rollout_length:
+                self.update_batch(states, actions, rewards, next_states, dones)
+                states, actions, rewards, next_states, dones = [], [], [], [], []
+
+        self.epoch += 1
+        return steps, total_return, r
 
     '''
     Interface method
     '''
     def single_episode_train(self, env):
+        if self.batch_updates:
+            return self.batched_episode_train(env)
+        elif self.shared:
+            return self.shared_episode_train(env)
         steps = 0
         done = False
         s = env.reset()
         total_return = 0
         actions = []
-        n_actions = env.action_space.n
         while not done:
-            # predict action probabilities by critic model
-            y_s = self.actor_model.predict(s).squeeze()
+            # predict action probabilities by critic model and choose an action according to them
+            sampled, y_s, _ = self.actor_model.sample_actions(s)
+            a = sampled[0]
             if self.verbose:
                 print("Step %d:" % steps)
-                print("Observed state %s. Predicted critic values: %s" % (s, y_s))
-            # choose action according to critic's probability predition
-            a = np.random.choice(n_actions, p=y_s)
+                print("Observed state %s. Predicted critic values: %s" % (s, y_s[0]))
             actions.append(a)
             s2, r, done, _ = env.step(a)
             total_return += r
@@ -199,7 +400,9 @@ class PolicyGradientAgent(object):
     Interface method
     '''
     def optimal_action(self, s, action_space):
-        y = self.actor_model.predict(s).squeeze()
-        a_good = np.random.choice(action_space, p=y)
-        # a_bad = np.argmax(y)
-        return a_good
\ No newline at end of file
+        a_good = self.actor_model.sample_action(s)
+        # a_bad = np.argmax(self.actor_model.predict(s))
+        return a_good
+
+    def close(self):
+        self.session.close()
@@ -7,35 +7,136 @@ Created on Apr 20, 2017
 import sys
 import timeit
 from rl_gym.environments.grid_world import *
+from rl_gym.models.tabular_models import save_tables, open_tables, open_or_create_tables, is_tables_file
 import numpy as np
 
 
 class PolicyIterationAgent(object):
-    def __init__(self, num_states, actions, gamma=0.9):
+    def __init__(self, num_states, actions, gamma=0.9, vectorized=False, table_file=None, block_size=None):
         self.gamma = gamma
-        self.V = np.zeros(num_states)
-        self.policy = np.random.choice(actions, num_states)
+        self.table_file = table_file
+        self.block_size = block_size
+        if table_file != None:
+            # V and policy live in a memory mapped file, only pages in use stay resident.
+            # An existing table file of this world is reopened and training resumes from it
+            tables, created = open_or_create_tables(table_file, [('V', np.float64, (num_states,)), ('policy', np.int8, (num_states,))], "policy table")
+            self.V = tables['V']
+            self.policy = tables['policy']
+            if created:
+                step = block_size if block_size != None else num_states
+                for start in range(0, num_states, step):
+                    self.policy[start:start + step] = np.random.choice(actions, min(step, num_states - start))
+        else:
+            self.V = np.zeros(num_states)
+            self.policy = np.random.choice(actions, num_states)
+        self.vectorized = vectorized
+        self.changed_actions = None
+        # (trained states, valid states, next states, rewards), computed on the first vectorized iteration
+        self.transitions = None
 
     def display_functions(self, env):
         env.show_values(self.V)
         env.show_policy(self.policy)
 
-    def load_model(self, file_name):
-        model = np.fromfile(file_name)
-        self.V = model.reshape(2, int(model.size / 2))[0]
-        self.policy = model.reshape(2, int(model.size / 2))[1]
+    def load_model(self, file_name, mode='c'):
+        if is_tables_file(file_name):
+            arrays = open_tables(file_name, mode)
+            self.V = arrays['V']
+            self.policy = arrays['policy']
+        else:
+            # Old raw format: V and policy as two float64 rows
+            model = np.fromfile(file_name)
+            self.V = model.reshape(2, int(model.size / 2))[0]
+            self.policy = model.reshape(2, int(model.size / 2))[1].astype(np.int8)
 
     '''
     Interface method
     '''    
     def save_model(self, file_name):
-        model = np.concatenate((self.V.reshape(1, self.V.size), self.policy.reshape(1, self.policy.size)))
-        model.tofile(file_name)
+        if file_name == self.table_file:
+            self.V.flush()
+            self.policy.flush()
+        else:
+            save_tables(file_name, [('V', self.V), ('policy', self.policy.astype(np.int8))])
     
+    def evaluate_states(self, s, s_prime, r):
+        rows = np.arange(len(s))
+        a = self.policy[s]
+        self.V[s] = r[rows, a] + self.gamma * self.V[s_prime[rows, a]]
+
+    def improve_states(self, s, s_prime, r):
+        # returns number of changed actions
+        Q = r + self.gamma * self.V[s_prime]
+        best_actions = np.argmax(Q, axis=1)
+        changed = int(np.count_nonzero(best_actions != self.policy[s]))
+        self.policy[s] = best_actions
+        return changed
+
+    def vectorized_iteration_train(self, env_factory, states, verbosity=0):
+        # Same evaluation and improvement steps computed for all states at once. The evaluation sweep
+        # reads V from the previous sweep instead of values already updated in this one.
+        s, s_prime, r = self.transitions_of(env_factory, states)
+        if verbosity >= 1:
+            print("Updating Value function. Policy improvement.")
+        self.evaluate_states(s, s_prime, r)
+
+        if verbosity >= 1:
+            print("Policy evaluation")
+        self.changed_actions = self.improve_states(s, s_prime, r)
+        if verbosity >= 1:
+            print("%d actions changed" % self.changed_actions)
+        return len(states)
+
+    def blocked_iteration_train(self, env_factory, states, verbosity=0):
+        # Out of core variant of vectorized_iteration_train: transitions are computed for one block of
+        # states at a time and dropped, so resident memory is bounded by the block size and the pages
+        # of V and policy in use.
+        cls = env_factory.environment_class()
+        if verbosity >= 1:
+            print("Updating Value function. Policy improvement.")
+        for start in range(0, len(states), self.block_size):
+            s_prime, r, valid = cls.transitions(states[start:start + self.block_size])
+            s = np.asarray(states[start:start + self.block_size], dtype=np.int64)[valid]
+            self.evaluate_states(s, s_prime[valid], r[valid])
+            if verbosity <= 1:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+        print()
+
+        if verbosity >= 1:
+            print("Policy evaluation")
+        self.changed_actions = 0
+        for start in range(0, len(states), self.block_size):
+            s_prime, r, valid = cls.transitions(states[start:start + self.block_size])
+            s = np.asarray(states[start:start + self.block_size], dtype=np.int64)[valid]
+            self.changed_actions += self.improve_states(s, s_prime[valid], r[valid])
+            if verbosity <= 1:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+        print()
+
+        if self.table_file != None:
+            self.V.flush()
+            self.policy.flush()
+        if verbosity >= 1:
+            print("%d actions changed" % self.changed_actions)
+        return len(states)
+
+    def transitions_of(self, env_factory, states):
+        states = np.asarray(states, dtype=np.int64)
+        if self.transitions == None or not np.array_equal(self.transitions[0], states):
+            s_prime, r, valid = env_factory.environment_class().transitions(states)
+            self.transitions = (states, states[valid], s_prime[valid], r[valid])
+        return self.transitions[1:]
+
     '''
     Interface method
     '''
     def single_iteration_train(self, env_factory, states, verbosity=0):
+        if self.block_size != None:
+            return self.blocked_iteration_train(env_factory, states, verbosity)
+        if self.vectorized:
+            return self.vectorized_iteration_train(env_factory, states, verbosity)
         if verbosity >= 1:
             print("Updating Value function. Policy improvement.")
         for s in states:
@@ -0,0 +1,72 @@
+import heapq
+
+from rl_gym.agents.dyna_q_agent import DynaQTabularAgent
+
+class PrioritizedSweepingAgent(DynaQTabularAgent):
+    '''
+    Prioritized sweeping: instead of replaying uniformly sampled pairs like Dyna-Q, the planning budget
+    goes to the state-action pairs with the largest Bellman error. When Q(s, .) changes, the
+    predecessors of s in the learned model are queued with their new error, so value changes spread
+    backwards from the goal without sweeping the whole table.
+    '''
+    def __init__(self, num_states, num_actions, planning_steps=10, theta=10e-4, eps=1.0, eps_decay = 0.99, eps_min=0.05, gamma=0.9, alpha=0.1, env_descriptor = None, verbose=False):
+        super(PrioritizedSweepingAgent, self).__init__(num_states, num_actions, planning_steps=planning_steps, eps=eps, eps_decay=eps_decay, eps_min=eps_min, gamma=gamma, alpha=alpha, env_descriptor=env_descriptor, verbose=verbose)
+        self.theta = theta
+        # s2 -> set of pairs s * num_actions + a observed to lead to s2
+        self.predecessors = {}
+        # max-heap of (-priority, pair); outdated entries are skipped when popped
+        self.queue = []
+        self.priorities = {}
+
+    def record(self, s, a, s2, r, done):
+        old_s2 = self.model_s2[s * self.num_actions + a]
+        super(PrioritizedSweepingAgent, self).record(s, a, s2, r, done)
+        sa = s * self.num_actions + a
+        new_s2 = self.model_s2[sa]
+        if new_s2 != old_s2:
+            if old_s2 >= 0:
+                self.predecessors[old_s2].discard(sa)
+            if new_s2 >= 0:
+                self.predecessors.setdefault(new_s2, set()).add(sa)
+
+    def bellman_error(self, sa):
+        s2 = self.model_s2[sa]
+        target = self.model_r[sa]
+        if not self.model_done[sa]:
+            target += self.gamma * self.Q.values[s2].max()
+        return target - self.Q.values.flat[sa]
+
+    def push(self, sa):
+        p = abs(self.bellman_error(sa))
+        if p > self.theta and p > self.priorities.get(sa, 0):
+            self.priorities[sa] = p
+            heapq.heappush(self.queue, (-p, sa))
+
+    def pop(self):
+        while self.queue:
+            p, sa = heapq.heappop(self.queue)
+            if self.priorities.get(sa) == -p:
+                del self.priorities[sa]
+                return sa
+        return None
+
+    def plan(self):
+        for _ in range(self.planning_steps):
+            sa = self.pop()
+            if sa == None:
+                break
+            s = sa // self.num_actions
+            a = sa % self.num_actions
+            delta = self.bellman_error(sa)
+            self.Q[s][a] += self.alpha / self.update_counts_sa[s][a] * delta
+            self.update_counts_sa[s][a] += 0.005
+            for pred in self.predecessors.get(s, ()):
+                self.push(pred)
+
+    def learn(self, s, a, r, s2, done):
+        # The real transition only updates the model and queues the pair, all value updates happen in planning
+        self.record(s, a, s2, r, done)
+        sa = s * self.num_actions + a
+        if self.model_s2[sa] >= 0:
+            self.push(sa)
+        self.plan()
@@ -8,7 +8,21 @@ import sys
 import timeit
 import numpy as np
 
-class QLearningTabularAgent(object):
+from rl_gym.environments.grid_world import VectorEnvironment
+from rl_gym.agents.tabular_agent import TabularAgent
+from rl_gym.models.tabular_models import SharedQTable, td_update, update_traces, save_q_tables, load_q_tables
+from rl_gym.utils.threading.worker import WorkersGroup
+
+def hogwild_episodes(agent, env_factory, num_episodes, seed):
+    # Runs in a worker process, agent.Q and agent.update_counts_sa are shared with the other workers
+    np.random.seed(seed)
+    steps = 0
+    for _ in range(num_episodes):
+        stps, _, _ = agent.single_episode_train(env_factory.create_environment())
+        steps += stps
+    return steps, agent.random_actions, agent.greedy_actions
+
+class QLearningTabularAgent(TabularAgent):
     def __init__(self, eps=1.0, eps_decay = 0.99, eps_min=0.05, gamma=0.9, alpha=0.1, env_descriptor = None, verbose=False):
         self.eps = eps
         self.eps_decay = eps_decay
@@ -50,6 +64,12 @@ class QLearningTabularAgent(object):
         for s in sorted(Q):
             print("%s %s" % (s, str(self.Q[s])))
 
+    def learn(self, s, a, r, s2, done):
+        # Q-learning update of Q(s,a) from one real step
+        alpha = self.alpha / self.update_counts_sa[s][a]
+        self.update_counts_sa[s][a] += 0.005
+        self.Q[s][a] = self.Q[s][a] + alpha * (r + self.gamma * self.Q[s2].max() - self.Q[s][a])
+
     def single_episode_train(self, env):
 #         start_time = timeit.default_timer()
         # loops until grid is solved
@@ -76,9 +96,7 @@ class QLearningTabularAgent(object):
             if s not in self.update_counts_sa:
                 self.update_counts_sa[s] = np.ones(env.action_space.n)
 
-            alpha = self.alpha / self.update_counts_sa[s][a]
-            self.update_counts_sa[s][a] += 0.005
-            self.Q[s][a] = self.Q[s][a] + alpha * (r + self.gamma * self.Q[s2].max() - self.Q[s][a])
+            self.learn(s, a, r, s2, done)
                 
             steps += 1
             # Increase epsilon as workaround to stacking in infinite actions chain
@@ -114,11 +132,8 @@ class QLearningTabularAgent(object):
         env.show_policy(policy)
         pass
     
-    def load_model(self, file_name):
-#         model = np.fromfile(file_name)
-#         self.V = model.reshape(2, int(model.size / 2))[0]
-#         self.policy = model.reshape(2, int(model.size / 2))[1]
-        pass
+    def load_model(self, file_name, mode='c'):
+        self.Q, self.update_counts_sa, _ = load_q_tables(file_name, mode)
 
     def adjust(self):
         pass
@@ -126,10 +141,8 @@ class QLearningTabularAgent(object):
     '''
     Interface method
     '''    
-    def save_model(self, file_name):
-#         model = np.concatenate((self.V.reshape(1, self.V.size), self.policy.reshape(1, self.policy.size)))
-#         model.tofile(file_name)
-        pass
+    def save_model(self, file_name, num_states=None, num_actions=None):
+        save_q_tables(file_name, self.Q, self.update_counts_sa, num_states, num_actions, env_descriptor=self.env_descriptor)
     
     '''
     Interface method
@@ -153,6 +166,83 @@ class QLearningTabularAgent(object):
         print()
         return steps
 
+    '''
+    Interface method
+    '''
+    def batched_iteration_train(self, env_factory, states, num_worlds=64, verbosity=0):
+        if verbosity >= 1:
+            print("Updating Value function. Policy improvement.")
+
+        env = env_factory.create_environment()
+        n_actions = env.action_space.n
+        self.dense_tables(env.num_states, n_actions)
+
+        worlds = VectorEnvironment(env_factory, num_worlds, len(states))
+        steps = 0
+        s = worlds.reset()
+        while len(s) > 0:
+            a = self.choose_actions(s, n_actions)
+            s2, r, done = worlds.step(a)
+            self.Q.touch(s2)
+
+            targets = r + self.gamma * self.Q.values[s2].max(axis=1)
+            td_update(self.Q, self.update_counts_sa, s, a, targets, self.alpha)
+            steps += len(s)
+
+            started = worlds.started
+            s, _, _ = worlds.advance(s2, done)
+            for _ in range(np.count_nonzero(done)):
+                self.epoch += 1
+                if self.eps > self.eps_min:
+                    self.eps *= self.eps_decay
+            if started // 1000 != worlds.started // 1000 and verbosity <= 1:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+
+        print()
+        return steps
+
+    '''
+    Interface method
+    '''
+    def parallel_iteration_train(self, env_factory, states, num_workers=4, verbosity=0):
+        # Hogwild: workers run episodes and update one shared Q table without locks
+        env = env_factory.create_environment()
+        self.dense_tables(env.num_states, env.action_space.n)
+        Q, update_counts = self.Q, self.update_counts_sa
+        self.Q = SharedQTable.from_table(Q)
+        self.update_counts_sa = SharedQTable.from_table(update_counts)
+        random_actions, greedy_actions = self.random_actions, self.greedy_actions
+        try:
+            episodes = [len(chunk) for chunk in np.array_split(np.arange(len(states)), num_workers)]
+            seeds = np.random.randint(2 ** 31 - 1, size=num_workers)
+            args_list = [(self, env_factory, episodes[i], seeds[i]) for i in range(num_workers)]
+            results = WorkersGroup(num_workers, hogwild_episodes, args_list=args_list).run()
+            np.copyto(Q.values, self.Q.values)
+            np.copyto(Q.visited, self.Q.visited)
+            np.copyto(update_counts.values, self.update_counts_sa.values)
+            np.copyto(update_counts.visited, self.update_counts_sa.visited)
+        finally:
+            self.Q.release()
+            self.update_counts_sa.release()
+            self.Q, self.update_counts_sa = Q, update_counts
+
+        steps = 0
+        for i in range(num_workers):
+            if results[i] == None:
+                raise RuntimeError("Worker %d failed" % i)
+            stps, worker_random, worker_greedy = results[i]
+            steps += stps
+            self.random_actions += worker_random - random_actions
+            self.greedy_actions += worker_greedy - greedy_actions
+        for _ in range(len(states)):
+            self.epoch += 1
+            if self.eps > self.eps_min:
+                self.eps *= self.eps_decay
+
+        print()
+        return steps
+
     '''
     Interface method
     '''
@@ -247,3 +337,56 @@ class QLearningFunctionAproximationAgent(object):
     '''
     def optimal_action(self, s, action_space):
         return np.argmax(self.model.predict(s))
+
+class QLambdaTabularAgent(QLearningTabularAgent):
+    '''
+    Watkins's Q(lambda) with replacing eligibility traces. Traces are kept only for recently visited
+    state-action pairs, dropped once they decay below trace_cutoff and cut after an exploratory
+    action, so a step costs O(active pairs) instead of O(|S|).
+    '''
+    def __init__(self, eps=1.0, eps_decay = 0.99, eps_min=0.05, gamma=0.9, alpha=0.1, lambda_=0.9, trace_cutoff=0.01, env_descriptor = None, verbose=False):
+        super(QLambdaTabularAgent, self).__init__(eps=eps, eps_decay=eps_decay, eps_min=eps_min, gamma=gamma, alpha=alpha, env_descriptor=env_descriptor, verbose=verbose)
+        self.lambda_ = lambda_
+        self.trace_cutoff = trace_cutoff
+
+    def single_episode_train(self, env):
+        steps = 0
+        total_return = 0
+        # (s, a) -> eligibility of the pair
+        traces = {}
+        s = env.reset()
+        if s not in self.Q:
+            self.Q[s] = np.zeros(env.action_space.n)
+        a = self.choose_action(env, s)
+        done = False
+        while not done:
+            s2, r, done, _ = env.step(a)
+            total_return += r
+
+            if s2 not in self.Q:
+                self.Q[s2] = np.zeros(env.action_space.n)
+            # the next action is needed in advance to know whether the traces survive this step
+            a2 = self.choose_action(env, s2)
+            q_max = self.Q[s2].max()
+
+            if s not in self.update_counts_sa:
+                self.update_counts_sa[s] = np.ones(env.action_space.n)
+            delta = r + self.gamma * q_max - self.Q[s][a]
+            traces[(s, a)] = 1.0
+            update_traces(self.Q, self.update_counts_sa, traces, delta, self.alpha, self.gamma * self.lambda_, self.trace_cutoff, cut=self.Q[s2][a2] != q_max)
+            self.update_counts_sa[s][a] += 0.005
+
+            a = a2
+            s = s2
+            steps += 1
+
+        if self.verbose:
+            print("\nEpisode finished with reward %f" % r)
+            print("Q table:")
+            self.print_Q(self.Q)
+            print()
+        self.epoch += 1
+        if self.eps > self.eps_min:
+            self.eps *= self.eps_decay
+
+        return steps, total_return, r
@@ -8,7 +8,11 @@ import sys
 import timeit
 import numpy as np
 
-class SarsaTabularAgent(object):
+from rl_gym.environments.grid_world import VectorEnvironment
+from rl_gym.agents.tabular_agent import TabularAgent
+from rl_gym.models.tabular_models import td_update, update_traces, save_q_tables, load_q_tables
+
+class SarsaTabularAgent(TabularAgent):
     def __init__(self, eps=1.0, eps_decay = 0.99, eps_min=0.05, gamma=0.9, alpha=0.1, env_descriptor = None, verbose=False):
         self.eps = eps
         self.eps_decay = eps_decay
@@ -115,19 +119,14 @@ class SarsaTabularAgent(object):
         env.show_policy(policy)
         pass
     
-    def load_model(self, file_name):
-#         model = np.fromfile(file_name)
-#         self.V = model.reshape(2, int(model.size / 2))[0]
-#         self.policy = model.reshape(2, int(model.size / 2))[1]
-        pass
+    def load_model(self, file_name, mode='c'):
+        self.Q, self.update_counts_sa, _ = load_q_tables(file_name, mode)
 
     '''
     Interface method
     '''    
-    def save_model(self, file_name):
-#         model = np.concatenate((self.V.reshape(1, self.V.size), self.policy.reshape(1, self.policy.size)))
-#         model.tofile(file_name)
-        pass
+    def save_model(self, file_name, num_states=None, num_actions=None):
+        save_q_tables(file_name, self.Q, self.update_counts_sa, num_states, num_actions, env_descriptor=self.env_descriptor)
     
     '''
     Interface method
@@ -154,6 +153,47 @@ class SarsaTabularAgent(object):
         print()
         return steps
 
+    '''
+    Interface method
+    '''
+    def batched_iteration_train(self, env_factory, states, num_worlds=64, verbosity=0):
+        if verbosity >= 1:
+            print("Updating Value function. Policy improvement.")
+
+        env = env_factory.create_environment()
+        n_actions = env.action_space.n
+        self.dense_tables(env.num_states, n_actions)
+
+        worlds = VectorEnvironment(env_factory, num_worlds, len(states))
+        steps = 0
+        s = worlds.reset()
+        a = self.choose_actions(s, n_actions)
+        while len(s) > 0:
+            s2, r, done = worlds.step(a)
+            # we need the next actions as well since Q(s,a) depends on Q(s',a')
+            a2 = self.choose_actions(s2, n_actions)
+
+            targets = r + self.gamma * self.Q.values[s2, a2]
+            td_update(self.Q, self.update_counts_sa, s, a, targets, self.alpha)
+            steps += len(s)
+
+            started = worlds.started
+            s, kept, restarted = worlds.advance(s2, done)
+            # continuing worlds keep their already chosen action, new worlds need a first one
+            a = a2[kept]
+            if restarted.any():
+                a[restarted] = self.choose_actions(s[restarted], n_actions)
+            for _ in range(np.count_nonzero(done)):
+                self.epoch += 1
+                if self.eps > self.eps_min:
+                    self.eps *= self.eps_decay
+            if started // 1000 != worlds.started // 1000 and verbosity <= 1:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+
+        print()
+        return steps
+
     '''
     Interface method
     '''
@@ -163,3 +203,55 @@ class SarsaTabularAgent(object):
         else:
             # if we didn't seen this state before just return rundom_action
             return np.random.choice(action_space)
+
+class SarsaLambdaTabularAgent(SarsaTabularAgent):
+    '''
+    SARSA(lambda) with replacing eligibility traces. Traces are kept only for recently visited
+    state-action pairs and dropped once they decay below trace_cutoff, so a step costs
+    O(active pairs) instead of O(|S|).
+    '''
+    def __init__(self, eps=1.0, eps_decay = 0.99, eps_min=0.05, gamma=0.9, alpha=0.1, lambda_=0.9, trace_cutoff=0.01, env_descriptor = None, verbose=False):
+        super(SarsaLambdaTabularAgent, self).__init__(eps=eps, eps_decay=eps_decay, eps_min=eps_min, gamma=gamma, alpha=alpha, env_descriptor=env_descriptor, verbose=verbose)
+        self.lambda_ = lambda_
+        self.trace_cutoff = trace_cutoff
+
+    def single_episode_train(self, env):
+        steps = 0
+        total_return = 0
+        # (s, a) -> eligibility of the pair
+        traces = {}
+        s = env.reset()
+        if s not in self.Q:
+            self.Q[s] = np.zeros(env.action_space.n)
+        a = self.choose_action(env, s)
+        done = False
+        while not done:
+            s2, r, done, _ = env.step(a)
+            total_return += r
+
+            if s2 not in self.Q:
+                self.Q[s2] = np.zeros(env.action_space.n)
+            a2 = self.choose_action(env, s2)
+
+            if s not in self.update_counts_sa:
+                self.update_counts_sa[s] = np.ones(env.action_space.n)
+            delta = r + self.gamma * self.Q[s2][a2] - self.Q[s][a]
+            traces[(s, a)] = 1.0
+            update_traces(self.Q, self.update_counts_sa, traces, delta, self.alpha, self.gamma * self.lambda_, self.trace_cutoff)
+            self.update_counts_sa[s][a] += 0.005
+
+            a = a2
+            s = s2
+            steps += 1
+
+        if self.verbose:
+            print("\nEpisode finished with reward %f" % r)
+            print("Q table:")
+            self.print_Q(self.Q)
+            print()
+
+        self.epoch += 1
+        if self.eps > self.eps_min:
+            self.eps *= self.eps_decay
+
+        return steps, total_return, r
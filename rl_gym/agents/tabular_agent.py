@@ -0,0 +1,21 @@
+import numpy as np
+
+from rl_gym.models.tabular_models import QTable, epsilon_greedy
+
+class TabularAgent(object):
+    '''
+    Batched helpers of the tabular TD agents. Their Q and update_counts_sa are dictionaries
+    until a batched or parallel train moves them into QTables.
+    '''
+    def dense_tables(self, num_states, num_actions):
+        # Move Q and update counts into contiguous arrays, keeping everything learned so far
+        if not isinstance(self.Q, QTable):
+            self.Q = QTable.from_dict(self.Q, num_states, num_actions)
+            self.update_counts_sa = QTable.from_dict(self.update_counts_sa, num_states, num_actions, fill=1.0)
+
+    def choose_actions(self, s, n_actions):
+        self.Q.touch(s)
+        a, explore = epsilon_greedy(self.Q, s, self.eps, n_actions)
+        self.random_actions += np.count_nonzero(explore)
+        self.greedy_actions += len(s) - np.count_nonzero(explore)
+        return a
@@ -8,6 +8,9 @@ from __future__ import print_function
 import sys
 import numpy as np
 import timeit
+from concurrent.futures import ProcessPoolExecutor
+
+from rl_gym.models.tabular_models import QTable, PolicyTable
 
 REWARD_GOAL = 10
 REWARD_PIT = -10
@@ -25,7 +28,7 @@ class EnvironmentFactory:
     def __init__(self, env_type):
         self.env_type = env_type
         
-    def create_environment(self, state=None):
+    def environment_class(self):
         if self.env_type == EnvironmentFactory.EnvironmentType.Deterministic:
             cls = DeterministicEnvironment
         elif self.env_type == EnvironmentFactory.EnvironmentType.RandomPlayer:
@@ -38,6 +41,10 @@ class EnvironmentFactory:
             cls = FullyRandomEnvironment
         else:
             cls = None
+        return cls
+
+    def create_environment(self, state=None):
+        cls = self.environment_class()
         
         if state == None:
             env = cls()
@@ -173,6 +180,43 @@ class EnvironmentBase(object):
                                      
         return res
     
+    @classmethod
+    def transitions(cls, states):
+        '''
+        Vectorized simulate_step of a fresh world for every given state and every action.
+        Returns next states and rewards as (len(states), num_actions) arrays and the mask of valid states.
+        '''
+        states = np.asarray(states, dtype=np.int64)
+        player = cls.player_abs_from_state(states)
+        goal = cls.goal_abs_from_state(states)
+        pit = cls.pit_abs_from_state(states)
+        wall = cls.wall_abs_from_state(states)
+        valid = (player != goal) & (player != pit) & (player != wall) & (goal != pit) & (goal != wall) & (pit != wall)
+
+        row = (player // cls.size)[:, np.newaxis]
+        col = (player % cls.size)[:, np.newaxis]
+        # columns follow Action values: UP, DOWN, LEFT, RIGHT
+        new_row = row + np.array([-1, 1, 0, 0])
+        new_col = col + np.array([0, 0, -1, 1])
+        new_player = new_row * cls.size + new_col
+        moved = (new_row >= 0) & (new_row < cls.size) & (new_col >= 0) & (new_col < cls.size) & (new_player != np.atleast_1d(wall)[:, np.newaxis])
+        new_player = np.where(moved, new_player, player[:, np.newaxis])
+
+        next_states = states[:, np.newaxis] + (new_player - player[:, np.newaxis]) * cls.player_state_factor
+        rewards = np.full(next_states.shape, REWARD_STEP, dtype=np.float64)
+        rewards[new_player == np.atleast_1d(pit)[:, np.newaxis]] = REWARD_PIT
+        rewards[new_player == np.atleast_1d(goal)[:, np.newaxis]] = REWARD_GOAL
+        return next_states, rewards, valid
+
+    @classmethod
+    def initial_states(cls):
+        '''
+        States a new world of this class starts in. The random parts of a world are drawn uniformly
+        among the positions left free, so every valid state is equally likely.
+        '''
+        states = np.arange(cls.grid_size * cls.player_state_factor, dtype=np.int64)
+        return states[cls.transitions(states)[2]]
+
     @classmethod
     def from_state(cls, state):
         player = cls.player_abs_from_state(state)
@@ -251,6 +295,9 @@ class EnvironmentBase(object):
         print("")
 
 class DeterministicEnvironment(EnvironmentBase):
+    # weight of the player position in the state encoding
+    player_state_factor = 1
+
     def __init__(self, player=None, goal=None, pit=None, wall=None, state=None):
         self.num_states = self.grid_size
         self.steps = 0
@@ -293,6 +340,11 @@ class DeterministicEnvironment(EnvironmentBase):
         # In this environment wall is fixed
         return 10
 
+    @classmethod
+    def initial_states(cls):
+        # The player always starts in the top left corner
+        return np.zeros(1, dtype=np.int64)
+
 class RandomPlayerEnvironment(DeterministicEnvironment):
     def __init__(self, player=None, goal=None, pit=None, wall=None, state=None):
         self.num_states = self.grid_size
@@ -315,7 +367,14 @@ class RandomPlayerEnvironment(DeterministicEnvironment):
             self.player_cartesian = EnvironmentBase.abs_to_cartesian(self.player)
             self.state = self.player_abs_to_state(self.player)
 
+    @classmethod
+    def initial_states(cls):
+        return super(DeterministicEnvironment, cls).initial_states()
+
 class RandomGoalAndPlayerEnvironment(EnvironmentBase):
+    # weight of the player position in the state encoding
+    player_state_factor = EnvironmentBase.grid_size
+
     def __init__(self, player=None, goal=None, pit=None, wall=None, state=None):
         self.steps = 0
         if state != None:
@@ -348,12 +407,12 @@ class RandomGoalAndPlayerEnvironment(EnvironmentBase):
     @classmethod
     def player_abs_from_state(cls, state):
         # We need to find y coordinate from state = y*a + x so it just state/a
-        return int(state / cls.grid_size)
+        return state // cls.grid_size
     
     @classmethod
     def goal_abs_from_state(cls, state):
         # We need to find x coordinate from state = y*a + x so it just state mod a
-        return int(state % cls.grid_size)
+        return state % cls.grid_size
     
     @classmethod
     def pit_abs_from_state(cls, state):
@@ -366,6 +425,9 @@ class RandomGoalAndPlayerEnvironment(EnvironmentBase):
         return 10
 
 class RandomGoalPlayerAndPitEnvironment(EnvironmentBase):    
+    # weight of the player position in the state encoding
+    player_state_factor = EnvironmentBase.grid_size_square
+
     def __init__(self, player=None, goal=None, pit=None, wall=None, state=None):
         self.steps = 0
         if state != None:
@@ -402,17 +464,17 @@ class RandomGoalPlayerAndPitEnvironment(EnvironmentBase):
     @classmethod
     def player_abs_from_state(cls, state):
         # We need to find z coordinate from state = z*a^2 + y*a + x
-        return int(state / cls.grid_size_square)
+        return state // cls.grid_size_square
         
     @classmethod
     def goal_abs_from_state(cls, state):
         # We need to find y coordinate from state = z*a^2 + y*a + x
-        return int((state % cls.grid_size_square) / cls.grid_size)
+        return (state % cls.grid_size_square) // cls.grid_size
     
     @classmethod
     def pit_abs_from_state(cls, state):
         # We need to find x coordinate from state = z*a^2 + y*a + x
-        return int(float(state % cls.grid_size_square) % cls.grid_size)
+        return (state % cls.grid_size_square) % cls.grid_size
     
     @classmethod
     def wall_abs_from_state(cls, state):
@@ -421,6 +483,9 @@ class RandomGoalPlayerAndPitEnvironment(EnvironmentBase):
 
 
 class FullyRandomEnvironment(EnvironmentBase):
+    # weight of the player position in the state encoding
+    player_state_factor = EnvironmentBase.grid_size_cube
+
     def __init__(self, player=None, goal=None, pit=None, wall=None, state=None):
         self.steps = 0
         if state != None:
@@ -458,35 +523,156 @@ class FullyRandomEnvironment(EnvironmentBase):
     @classmethod
     def player_abs_from_state(cls, state):
         # We need to find z coordinate from state = z*a^3 + y*a^2 + x*a + w
-        return int(state / cls.grid_size_cube)
+        return state // cls.grid_size_cube
         
     @classmethod
     def goal_abs_from_state(cls, state):
         # We need to find y coordinate from state = z*a^3 + y*a^2 + x*a + w
-        return int((state % cls.grid_size_cube) / cls.grid_size_square)
+        return (state % cls.grid_size_cube) // cls.grid_size_square
     
     @classmethod
     def pit_abs_from_state(cls, state):
         # We need to find x coordinate from state = z*a^3 + y*a^2 + x*a + w
-        return int(((state % cls.grid_size_cube) % cls.grid_size_square) / cls.grid_size)
+        return ((state % cls.grid_size_cube) % cls.grid_size_square) // cls.grid_size
     
     @classmethod
     def wall_abs_from_state(cls, state):
         # We need to find w coordinate from state = z*a^3 + y*a^2 + x*a + w
-        return int(((state % cls.grid_size_cube) % cls.grid_size_square) % cls.grid_size) 
+        return ((state % cls.grid_size_cube) % cls.grid_size_square) % cls.grid_size
+
+
+class VectorEnvironment(object):
+    '''
+    Steps a batch of independent worlds created by env_factory with one call.
+    A finished world is replaced by a new one until num_episodes episodes were started,
+    after that it is dropped from the batch.
+    Worlds are only their encoded states and step counters, stepped with array arithmetic
+    like EnvironmentBase.transitions, so no environment object is created per episode.
+    '''
+    def __init__(self, env_factory, num_worlds, num_episodes):
+        self.env_factory = env_factory
+        self.env_class = env_factory.environment_class()
+        self.start_states = self.env_class.initial_states()
+        self.num_worlds = num_worlds
+        self.num_episodes = num_episodes
+        self.started = 0
+        self.states = np.zeros(0, dtype=np.int64)
+        self.steps = np.zeros(0, dtype=np.int64)
+
+    def _new_states(self, n):
+        self.started += n
+        return self.start_states[np.random.randint(len(self.start_states), size=n)]
+
+    def reset(self):
+        self.started = 0
+        self.states = self._new_states(min(self.num_worlds, self.num_episodes))
+        self.steps = np.zeros(len(self.states), dtype=np.int64)
+        return self.states.copy()
+
+    def step(self, actions):
+        cls = self.env_class
+        states = self.states
+        player = cls.player_abs_from_state(states)
+        row = player // cls.size + np.array([-1, 1, 0, 0])[actions]
+        col = player % cls.size + np.array([0, 0, -1, 1])[actions]
+        new_player = row * cls.size + col
+        moved = (row >= 0) & (row < cls.size) & (col >= 0) & (col < cls.size) & (new_player != cls.wall_abs_from_state(states))
+        new_player = np.where(moved, new_player, player)
+        self.states = states + (new_player - player) * cls.player_state_factor
+
+        at_pit = new_player == cls.pit_abs_from_state(states)
+        at_goal = new_player == cls.goal_abs_from_state(states)
+        r = np.full(len(states), REWARD_STEP, dtype=np.float64)
+        r[at_pit] = REWARD_PIT
+        r[at_goal] = REWARD_GOAL
+        done = at_pit | at_goal
+        # a world running out of steps hangs whatever its last move was
+        self.steps += 1
+        hang = self.steps >= cls.grid_size
+        r[hang] = REWARD_HANG
+        done |= hang
+        return self.states.copy(), r, done
+
+    def advance(self, s2, done):
+        '''
+        Replaces finished worlds. Returns states of the remaining worlds, their indices in the
+        previous batch and the mask of worlds which were restarted.
+        '''
+        finished = np.flatnonzero(done)
+        restart = finished[:max(0, min(len(finished), self.num_episodes - self.started))]
+        restarted = np.zeros(len(done), dtype=bool)
+        restarted[restart] = True
+        states = np.array(s2, dtype=np.int64)
+        states[restart] = self._new_states(len(restart))
+        self.steps[restart] = 0
 
+        kept = np.flatnonzero(~np.asarray(done, dtype=bool) | restarted)
+        self.states = states[kept]
+        self.steps = self.steps[kept]
+        return self.states.copy(), kept, restarted[kept]
+
+class PolicySnapshot(object):
+    '''
+    Immutable copy of an agent's greedy policy. It is cheap to pickle and exposes the
+    optimal_action/display_functions interface, so it can be evaluated in another process
+    while the agent keeps training.
+    '''
+    def __init__(self, agent):
+        Q = getattr(agent, 'Q', None)
+        if isinstance(Q, QTable):
+            self.policy = PolicyTable(Q.num_states, np.argmax(Q.values, axis=1).astype(np.int8), Q.visited.copy())
+        elif Q != None:
+            self.policy = {s: np.argmax(Q[s]) for s in Q}
+        else:
+            self.policy = np.array(agent.policy, dtype=np.int8)
+
+    def optimal_action(self, s, action_space):
+        if isinstance(self.policy, np.ndarray) or s in self.policy:
+            return self.policy[s]
+        else:
+            # if we didn't seen this state before just return rundom_action
+            return np.random.choice(action_space)
+
+    def display_functions(self, env):
+        env.show_policy(self.policy)
+
+def evaluate_snapshot(env_factory, snapshot, states, verbosity=0):
+    return GridWorldSolver(env_factory, snapshot).evaluate(states, verbosity=verbosity)
 
 class GridWorldSolver:
     def __init__(self, env_factory, agent):
         self.env_factory = env_factory
         self.agent = agent
+        self.executor = None
+    
+    def evaluate_async(self, states, verbosity=0, callback=None):
+        '''
+        Evaluates a snapshot of the current policy in a background process and returns a future with
+        the mean reward, training can go on meanwhile. callback(future) is called once it's finished.
+        '''
+        if self.executor == None:
+            self.executor = ProcessPoolExecutor(max_workers=1)
+        future = self.executor.submit(evaluate_snapshot, self.env_factory, PolicySnapshot(self.agent), states, verbosity)
+        if callback != None:
+            future.add_done_callback(callback)
+        return future
+
+    def close(self):
+        if self.executor != None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
     
-    def train(self, states, verbosity=0):
+    def train(self, states, verbosity=0, num_worlds=None, num_workers=None):
         if verbosity >= 1:
             print("Train agent for %d iterations." % len(states))
             start_time = timeit.default_timer()
         
-        steps = self.agent.single_iteration_train(self.env_factory, states, verbosity)
+        if num_worlds != None:
+            steps = self.agent.batched_iteration_train(self.env_factory, states, num_worlds, verbosity)
+        elif num_workers != None:
+            steps = self.agent.parallel_iteration_train(self.env_factory, states, num_workers, verbosity)
+        else:
+            steps = self.agent.single_iteration_train(self.env_factory, states, verbosity)
 
         if verbosity >= 1:
             elapsed = timeit.default_timer() - start_time
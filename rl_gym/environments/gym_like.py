@@ -4,6 +4,8 @@ Created on Apr 30, 2017
 @author: ny
 '''
 
+import numpy as np
+
 registry = {}
 
 def env_list():
@@ -16,4 +18,51 @@ def make(env_name):
     if env_name in registry:
         return registry[env_name]()
     else:
-        raise RuntimeError("Environment with name %s not registered." % env_name)
\ No newline at end of file
+        raise RuntimeError("Environment with name %s not registered." % env_name)
+
+class VectorEnv(object):
+    '''
+    Steps num_envs environments created by make_env() in lock step, for gym environments as well as
+    the registered grid worlds. Observations are returned as a float32 (num_envs, D) array.
+    A finished episode is reset right away, so the observation returned for a done environment
+    is the first one of its next episode. Steps, return and last reward of finished episodes
+    are collected in finished_episodes.
+    '''
+    def __init__(self, make_env, num_envs):
+        self.envs = [make_env() for _ in range(num_envs)]
+        self.action_space = self.envs[0].action_space
+        self.episode_steps = np.zeros(num_envs, dtype=np.int64)
+        self.episode_returns = np.zeros(num_envs)
+        self.finished_episodes = []
+
+    def __len__(self):
+        return len(self.envs)
+
+    def observations(self, obs):
+        return np.array(obs, dtype=np.float32).reshape(len(self.envs), -1)
+
+    def reset(self):
+        self.episode_steps.fill(0)
+        self.episode_returns.fill(0)
+        return self.observations([env.reset() for env in self.envs])
+
+    def step(self, actions):
+        n = len(self.envs)
+        obs = [None] * n
+        rewards = np.empty(n, dtype=np.float32)
+        dones = np.empty(n, dtype=bool)
+        for i in range(n):
+            obs[i], rewards[i], dones[i], _ = self.envs[i].step(actions[i])
+            if dones[i]:
+                obs[i] = self.envs[i].reset()
+        self.episode_steps += 1
+        self.episode_returns += rewards
+        for i in np.flatnonzero(dones):
+            self.finished_episodes.append((int(self.episode_steps[i]), float(self.episode_returns[i]), float(rewards[i])))
+        self.episode_steps[dones] = 0
+        self.episode_returns[dones] = 0
+        return self.observations(obs), rewards, dones
+
+    def close(self):
+        for env in self.envs:
+            env.close()
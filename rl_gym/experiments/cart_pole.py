@@ -12,7 +12,8 @@ from datetime import datetime
 from rl_gym.models.linear_models import RbfRegressor
 from rl_gym.models.mlp_models import FeedForwardModel
 from rl_gym.agents.qlearning_agent import QLearningFunctionAproximationAgent
-from rl_gym.agents.policy_gradient_agent import PolicyGradientAgent, ValueModel, PolicyModel
+from rl_gym.agents.policy_gradient_agent import PolicyGradientAgent, ValueModel, PolicyModel, ActorCriticModel
+from rl_gym.agents.a2c_agent import A2CAgent
 from rl_gym.agents.dqn_agent import DQNAgent, DQNModel
 
 import matplotlib.pyplot as plt
@@ -48,16 +49,25 @@ def create_agent(agent_name, env, verbose):
         model, gamma = create_model(env, models[1], verbose=verbose)
         agent = QLearningFunctionAproximationAgent(model=model, eps_decay=0.98, gamma=gamma, verbose=verbose)
     elif agent_name == 'pgrad':
-        actor = PolicyModel(env.observation_space.shape[0], env.action_space.n, [])
-        critic = ValueModel(env.observation_space.shape[0], [32, 16, 16])
+        with tf.Graph().as_default():
+            tf.set_random_seed(0)
+            actor = PolicyModel(env.observation_space.shape[0], env.action_space.n, [])
+            critic = ValueModel(env.observation_space.shape[0], [32, 16, 16])
         agent = PolicyGradientAgent(actor, critic, gamma=0.99)
+    elif agent_name == 'a2c':
+        with tf.Graph().as_default():
+            tf.set_random_seed(0)
+            actor_critic = ActorCriticModel(env.observation_space.shape[0], env.action_space.n, [32], critic_layer_sizes=[16])
+        agent = A2CAgent(lambda: gym.make('CartPole-v0'), actor_critic, num_envs=16, gamma=0.99)
     elif agent_name == 'dqn':
         D = len(env.observation_space.sample())
         K = env.action_space.n
         sizes = [200, 200]
         gamma = 0.99
-        model = DQNModel(D, K, sizes, gamma=gamma)
-        target_model = DQNModel(D, K, sizes, gamma=gamma)
+        with tf.Graph().as_default():
+            tf.set_random_seed(0)
+            model = DQNModel(D, K, sizes, gamma=gamma)
+            target_model = DQNModel(D, K, sizes, gamma=gamma)
         agent = DQNAgent(model, target_model, gamma=gamma, copy_period=50)
 
     return agent
@@ -67,7 +77,7 @@ if __name__ == '__main__':
     env.seed(0)
     verbose = False
 
-    agents = ['qlearning', 'pgrad', 'dqn']
+    agents = ['qlearning', 'pgrad', 'dqn', 'a2c']
     agent = create_agent(agents[2], env, verbose=verbose)
 
     monitor = False
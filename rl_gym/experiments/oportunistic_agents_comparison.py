@@ -15,8 +15,9 @@ tf.set_random_seed(0)
 from rl_gym.agents.monte_carlo_agent import MonteCarloTabularAgent
 from rl_gym.agents.sarsa_agent import SarsaTabularAgent
 from rl_gym.agents.qlearning_agent import QLearningTabularAgent, QLearningFunctionAproximationAgent
-from rl_gym.agents.policy_gradient_agent import PolicyGradientAgent, ValueModel, PolicyModel
+from rl_gym.agents.policy_gradient_agent import PolicyGradientAgent, ValueModel, PolicyModel, ActorCriticModel
 from rl_gym.agents.dqn_agent import DQNAgent, DQNModel
+from rl_gym.agents.a2c_agent import A2CAgent
 
 from rl_gym.environments import gym_like as gym
 from rl_gym.models.linear_models import RbfRegressor
@@ -27,6 +28,8 @@ GAMMA = 0.9
 ALPHA = 0.8
 
 REWARD_GOAL = 10
+# TensorFlow thread pool sizes of every agent, 0 uses all the cores
+TF_THREADS = 0
 
 def create_model(env, model_name, verbose=False):
     obs = env.reset()
@@ -47,6 +50,9 @@ def create_agent(env, agent_type, gamma, alpha, verbosity=0):
     class EnvDescriptor(object):
         def __init__(self):
             self.episod_limit = EnvironmentBase.grid_size
+            # observations aren't integer encoded states of a known world size
+            self.num_states = None
+            self.num_actions = None
         def action_to_str(self, action):
             return EnvironmentBase.action_to_str(action)
 
@@ -61,17 +67,32 @@ def create_agent(env, agent_type, gamma, alpha, verbosity=0):
         model, gamma = create_model(env, 'ff')
         agent = QLearningFunctionAproximationAgent(model=model, gamma=gamma, eps_decay=0.9, verbose=verbosity >= agent_verb_level)
     elif agent_type == "pg":
-        actor = PolicyModel(env.observation_space.shape[0], env.action_space.n, [])
-        critic = ValueModel(env.observation_space.shape[0], [64, 64])
-        agent = PolicyGradientAgent(actor, critic, gamma=0.99)
+        # every agent gets a graph of its own, so agents compared in one process don't share variables
+        with tf.Graph().as_default():
+            tf.set_random_seed(0)
+            actor = PolicyModel(env.observation_space.shape[0], env.action_space.n, [])
+            critic = ValueModel(env.observation_space.shape[0], [64, 64])
+        agent = PolicyGradientAgent(actor, critic, gamma=0.99, intra_op_threads=TF_THREADS, inter_op_threads=TF_THREADS)
+    elif agent_type == "pg_shared":
+        with tf.Graph().as_default():
+            tf.set_random_seed(0)
+            actor_critic = ActorCriticModel(env.observation_space.shape[0], env.action_space.n, [64], critic_layer_sizes=[64])
+        agent = PolicyGradientAgent(actor_critic, gamma=0.99, intra_op_threads=TF_THREADS, inter_op_threads=TF_THREADS)
+    elif agent_type == "a2c":
+        with tf.Graph().as_default():
+            tf.set_random_seed(0)
+            actor_critic = ActorCriticModel(env.observation_space.shape[0], env.action_space.n, [64], critic_layer_sizes=[64])
+        agent = A2CAgent(lambda: gym.make(env.name), actor_critic, num_envs=16, gamma=0.99, intra_op_threads=TF_THREADS, inter_op_threads=TF_THREADS)
     elif agent_type == "dqn":
         D = env.observation_space.shape[0]
         K = env.action_space.n
         sizes = [4, 4]
         gamma = 0.99
-        model = DQNModel(D, K, sizes, gamma=gamma, min_experiences=10, max_experiences=400, batch_sz=8)
-        target_model = DQNModel(D, K, sizes, gamma=gamma, min_experiences=10, max_experiences=400, batch_sz=4)
-        agent = DQNAgent(model, target_model, gamma=gamma, copy_period=50)
+        with tf.Graph().as_default():
+            tf.set_random_seed(0)
+            model = DQNModel(D, K, sizes, gamma=gamma, min_experiences=10, max_experiences=400, batch_sz=8)
+            target_model = DQNModel(D, K, sizes, gamma=gamma, min_experiences=10, max_experiences=400, batch_sz=4)
+        agent = DQNAgent(model, target_model, gamma=gamma, copy_period=50, intra_op_threads=TF_THREADS, inter_op_threads=TF_THREADS)
 
     return agent
 
@@ -15,7 +15,7 @@ if __name__ == '__main__':
     env = env_factory.create_environment()
     
     agent = PolicyIterationAgent(env.num_states, env.all_actions())
-    agent.load_model('vtable.bin')
+    agent.load_model('vtable.bin', mode='r')
     solver = GridWorldSolver(env_factory, agent)
     
     res = solver.evaluate(range(env.num_states), verbosity)
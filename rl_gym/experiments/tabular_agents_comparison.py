@@ -11,34 +11,48 @@ import numpy as np
 from rl_gym.environments.grid_world import GridWorldSolver, EnvironmentFactory, REWARD_GOAL
 from rl_gym.agents.monte_carlo_agent import MonteCarloTabularAgent
 from rl_gym.agents.policy_iteration_agent import PolicyIterationAgent
-from rl_gym.agents.sarsa_agent import SarsaTabularAgent
-from rl_gym.agents.qlearning_agent import QLearningTabularAgent
+from rl_gym.agents.sarsa_agent import SarsaTabularAgent, SarsaLambdaTabularAgent
+from rl_gym.agents.qlearning_agent import QLearningTabularAgent, QLambdaTabularAgent
+from rl_gym.agents.dyna_q_agent import DynaQTabularAgent
+from rl_gym.agents.prioritized_sweeping_agent import PrioritizedSweepingAgent
 
 np.random.seed(0)
 GAMMA = 0.7
 ALPHA = 0.8
+LAMBDA = 0.9
+PLANNING_STEPS = 20
 
 def create_agent(env, agent_type, gamma, alpha, verbosity=0):
     class EnvDescriptor:
         def __init__(self, env):
             self.env = env
             self.episod_limit = env.grid_size
+            self.num_states = env.num_states
+            self.num_actions = env.action_space.n
         def action_to_str(self, action):
             return env.action_to_str(action)
 
     agent_verb_level = 3
     if agent_type == "policy_it":
-        agent = PolicyIterationAgent(env.num_states, env.all_actions())
+        agent = PolicyIterationAgent(env.num_states, env.all_actions(), vectorized=True)
     elif agent_type == "monte_carlo":
         agent = MonteCarloTabularAgent(gamma=gamma, eps_decay=0.999, eps_min=0.2, env_descriptor=EnvDescriptor(env), verbose=verbosity >= agent_verb_level)
     elif agent_type == "sarsa":
         agent = SarsaTabularAgent(gamma=gamma, eps_decay=0.9, alpha=alpha, env_descriptor=EnvDescriptor(env), verbose=verbosity >= agent_verb_level)
     elif agent_type == "qlearning":
         agent = QLearningTabularAgent(gamma=gamma, alpha=alpha, env_descriptor=EnvDescriptor(env), verbose=verbosity >= agent_verb_level)
+    elif agent_type == "sarsa_lambda":
+        agent = SarsaLambdaTabularAgent(gamma=gamma, eps_decay=0.9, alpha=alpha, lambda_=LAMBDA, env_descriptor=EnvDescriptor(env), verbose=verbosity >= agent_verb_level)
+    elif agent_type == "qlearning_lambda":
+        agent = QLambdaTabularAgent(gamma=gamma, alpha=alpha, lambda_=LAMBDA, env_descriptor=EnvDescriptor(env), verbose=verbosity >= agent_verb_level)
+    elif agent_type == "dyna_q":
+        agent = DynaQTabularAgent(env.num_states, env.action_space.n, planning_steps=PLANNING_STEPS, gamma=gamma, alpha=alpha, env_descriptor=EnvDescriptor(env), verbose=verbosity >= agent_verb_level)
+    elif agent_type == "prioritized_sweeping":
+        agent = PrioritizedSweepingAgent(env.num_states, env.action_space.n, planning_steps=PLANNING_STEPS, gamma=gamma, alpha=alpha, env_descriptor=EnvDescriptor(env), verbose=verbosity >= agent_verb_level)
         
     return agent    
 
-def train_agent(agent_name, env_type, gamma, alpha, verbosity=1):
+def train_agent(agent_name, env_type, gamma, alpha, verbosity=1, num_worlds=None, num_workers=None, async_eval=False):
     env_factory = EnvironmentFactory(env_type)
     env = env_factory.create_environment()
     agent = create_agent(env, agent_name, gamma, alpha, verbosity=verbosity)
@@ -60,18 +74,38 @@ def train_agent(agent_name, env_type, gamma, alpha, verbosity=1):
     CONVERGENCE_LIMIT = 10e-3
     CONVERGENCE_STOP_COUNT = 2
 
+    pending_eval = None
+    # mean rewards of the finished evaluations, rewards has one entry per iteration
+    evaluations = []
+    # iterations trained while a background evaluation was running
+    unrecorded_iterations = 0
     while not converged:
         print("[%d] Train agent with all possible states" % total_iterations)
-        steps = solver.train(range(env.num_states), verbosity)
+        steps = solver.train(range(env.num_states), verbosity, num_worlds=num_worlds, num_workers=num_workers)
         total_steps += steps
-        print("[%d] Evaluate agent to test convergence" % total_iterations)
-        res = solver.evaluate(range(env.num_states), verbosity=verbosity)
+        if async_eval:
+            # Evaluate a policy snapshot in background and decide on the latest finished evaluation
+            if pending_eval == None:
+                print("[%d] Evaluate agent snapshot in background" % total_iterations)
+                pending_eval = solver.evaluate_async(range(env.num_states), verbosity=verbosity)
+            if not pending_eval.done():
+                total_iterations += 1
+                unrecorded_iterations += 1
+                continue
+            res = pending_eval.result()
+            pending_eval = None
+        else:
+            print("[%d] Evaluate agent to test convergence" % total_iterations)
+            res = solver.evaluate(range(env.num_states), verbosity=verbosity)
         print("Reward: %f" % res)
-        rewards.append(res.mean())
+        evaluations.append(res.mean())
+        # the iterations trained meanwhile are credited with this evaluation as well
+        rewards += [res.mean()] * (unrecorded_iterations + 1)
+        unrecorded_iterations = 0
         if res.max() == REWARD_GOAL:
             converged = True
-        if total_iterations > 0:
-            diff = rewards[total_iterations] - rewards[total_iterations - 1]
+        if len(evaluations) > 1:
+            diff = evaluations[-1] - evaluations[-2]
             if np.abs(diff) < CONVERGENCE_LIMIT:
                 convergence_count += 1 
         
@@ -83,6 +117,7 @@ def train_agent(agent_name, env_type, gamma, alpha, verbosity=1):
         total_iterations += 1
 #         break
     
+    solver.close()
     elapsed = timeit.default_timer() - start_time
     
     print("Evaluation finished.")
@@ -104,6 +139,7 @@ if __name__ == '__main__':
     # agents = ["monte_carlo", "sarsa", "qlearning"]
     # agents = ["sarsa", "qlearning"]
     # agents = ["sarsa"]
+    # agents = ["sarsa", "sarsa_lambda", "qlearning", "qlearning_lambda"]
 
     res = {}
     max_it = -1
@@ -0,0 +1,270 @@
+import numpy as np
+from collections import deque
+
+from rl_gym.models.tabular_models import open_or_create_tables
+
+class ReplayMemory(object):
+    '''
+    Fixed capacity circular buffer of transitions kept in preallocated typed arrays.
+    Adding a transition is O(1), once full it overwrites the oldest one.
+    Every transition has the discount of its bootstrapped value, gamma^n for n-step transitions.
+    '''
+    def __init__(self, capacity, state_shape, state_dtype=np.float32):
+        self.capacity = capacity
+        self.states = np.zeros((capacity,) + tuple(state_shape), dtype=state_dtype)
+        self.actions = np.zeros(capacity, dtype=np.int32)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.next_states = np.zeros((capacity,) + tuple(state_shape), dtype=state_dtype)
+        self.dones = np.zeros(capacity, dtype=bool)
+        self.discounts = np.zeros(capacity, dtype=np.float32)
+        self.pos = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, s, a, r, s2, done, discount):
+        i = self.pos
+        self.states[i] = s
+        self.actions[i] = a
+        self.rewards[i] = r
+        self.next_states[i] = s2
+        self.dones[i] = done
+        self.discounts[i] = discount
+        self.pos = (self.pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample_indices(self, batch_sz):
+        # Sampling with replacement is O(batch_sz), duplicates are rare for large memories
+        return np.random.randint(self.size, size=batch_sz)
+
+    def batch(self, idx):
+        return self.states[idx], self.actions[idx], self.rewards[idx], self.next_states[idx], self.dones[idx], self.discounts[idx]
+
+    def sample(self, batch_sz):
+        return self.batch(self.sample_indices(batch_sz))
+
+    def flush(self):
+        pass
+
+class MemoryMappedReplayMemory(ReplayMemory):
+    '''
+    Replay memory whose arrays live in a memory mapped tables file, so its size is bounded by disk
+    rather than RAM, and which can be reopened by a later run. Write position and size are kept in RAM
+    and mirrored into the file.
+    '''
+    def __init__(self, file_name, capacity, state_shape, state_dtype=np.float32):
+        state_shape = tuple(state_shape)
+        if len(state_shape) != 1:
+            raise RuntimeError("Only one dimensional states can be stored in %s" % file_name)
+        specs = [
+            ('states', state_dtype, (capacity,) + state_shape),
+            ('actions', np.int32, (capacity,)),
+            ('rewards', np.float32, (capacity,)),
+            ('next_states', state_dtype, (capacity,) + state_shape),
+            ('dones', bool, (capacity,)),
+            ('discounts', np.float32, (capacity,)),
+            ('index', np.int64, (2,))]
+        # never overwrite an existing file, reopen it only if it holds this very layout
+        arrays, _ = open_or_create_tables(file_name, specs, "replay memory")
+        self.file_name = file_name
+        self.capacity = capacity
+        self.states = arrays['states']
+        self.actions = arrays['actions']
+        self.rewards = arrays['rewards']
+        self.next_states = arrays['next_states']
+        self.dones = arrays['dones']
+        self.discounts = arrays['discounts']
+        self.index = arrays['index']
+        self.pos = int(self.index[0])
+        self.size = int(self.index[1])
+
+    def add(self, s, a, r, s2, done, discount):
+        super(MemoryMappedReplayMemory, self).add(s, a, r, s2, done, discount)
+        self.index[0] = self.pos
+        self.index[1] = self.size
+
+    def sample_indices(self, batch_sz):
+        # sorted indices turn the batch gather into one forward pass over the file
+        return np.sort(super(MemoryMappedReplayMemory, self).sample_indices(batch_sz))
+
+    def flush(self):
+        for array in [self.states, self.actions, self.rewards, self.next_states, self.dones, self.discounts, self.index]:
+            array.flush()
+
+class CompactReplayMemory(object):
+    '''
+    Replay memory storing the steps of episodes in order, with every observation kept once:
+    slot i holds s_t, a_t, r_t and whether the episode ended at that step. A transition sampled at i is
+    rebuilt as (s_t, a_t, R_n, s_t+n, done, gamma^n) from the next n slots, the n-step window stops at the
+    end of an episode. The final observation of an episode isn't stored, its value is masked anyway.
+    Steps must be added in episode order, and the last ones of an unfinished episode can't be sampled
+    until n more steps are added.
+    '''
+    def __init__(self, capacity, state_shape, gamma, n_steps=1, state_dtype=np.float32):
+        self.capacity = capacity
+        self.n_steps = n_steps
+        self.discounts = (gamma ** np.arange(n_steps + 1)).astype(np.float32)
+        self.states = np.zeros((capacity,) + tuple(state_shape), dtype=state_dtype)
+        self.actions = np.zeros(capacity, dtype=np.int32)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=bool)
+        self.pos = 0
+        self.size = 0
+        # steps of the current episode, the last n of them can't be sampled yet
+        self.episode_steps = 0
+
+    def __len__(self):
+        # number of steps that can be sampled
+        return max(0, self.size - min(self.episode_steps, self.n_steps))
+
+    def add(self, s, a, r, s2, done):
+        i = self.pos
+        self.states[i] = s
+        self.actions[i] = a
+        self.rewards[i] = r
+        self.dones[i] = done
+        self.pos = (self.pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.episode_steps = 0 if done else self.episode_steps + 1
+
+    def window(self, idx):
+        # slots of the n steps starting at idx, and which of them are still in the episode of idx
+        slots = (idx[:, None] + np.arange(self.n_steps)) % self.capacity
+        dones = self.dones[slots]
+        in_episode = np.cumsum(dones, axis=1) - dones == 0
+        return slots, dones, in_episode
+
+    def sample_indices(self, batch_sz):
+        # Resample the steps whose n-step window isn't written yet, unless their episode ended before
+        idx = np.random.randint(self.size, size=batch_sz)
+        while True:
+            steps_after = (self.pos - 1 - idx) % self.capacity
+            written = np.arange(self.n_steps) <= steps_after[:, None]
+            dones = self.dones[(idx[:, None] + np.arange(self.n_steps)) % self.capacity]
+            invalid = (steps_after < self.n_steps) & ~np.any(dones & written, axis=1)
+            if not invalid.any():
+                return idx
+            idx[invalid] = np.random.randint(self.size, size=np.count_nonzero(invalid))
+
+    def batch(self, idx):
+        slots, dones, in_episode = self.window(idx)
+        rewards = np.sum(self.rewards[slots] * in_episode * self.discounts[:self.n_steps], axis=1)
+        discounts = self.discounts[np.count_nonzero(in_episode, axis=1)]
+        next_states = self.states[(idx + self.n_steps) % self.capacity]
+        return self.states[idx], self.actions[idx], rewards, next_states, dones.any(axis=1), discounts
+
+    def sample(self, batch_sz):
+        return self.batch(self.sample_indices(batch_sz))
+
+    def flush(self):
+        pass
+
+class SumTree(object):
+    '''
+    Array based binary tree where every node holds the sum of its children. Leaves hold priorities,
+    node 1 is the root and children of node i are 2i and 2i+1. Updates and prefix-sum searches are
+    done for a whole batch of leaves at once, one tree level per step.
+    '''
+    def __init__(self, capacity):
+        self.num_leaves = 1
+        while self.num_leaves < capacity:
+            self.num_leaves *= 2
+        self.depth = int(np.log2(self.num_leaves))
+        self.tree = np.zeros(2 * self.num_leaves)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idx):
+        return self.tree[idx + self.num_leaves]
+
+    def update(self, idx, priorities):
+        nodes = np.atleast_1d(idx) + self.num_leaves
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        # index of the leaf where the cumulative sum of priorities reaches each value
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values > self.tree[left]
+            values -= self.tree[left] * go_right
+            nodes = left + go_right
+        return nodes - self.num_leaves
+
+class PrioritizedReplayMemory(ReplayMemory):
+    '''
+    Proportional prioritized replay: transition i is sampled with probability p_i^alpha / sum_k p_k^alpha
+    where p_i = |TD error| + eps, and is weighted by (N * P(i))^-beta / max weight in the loss.
+    beta is annealed to 1 by beta_increment per sampled batch.
+    '''
+    def __init__(self, capacity, state_shape, state_dtype=np.float32, alpha=0.6, beta=0.4, beta_increment=0.001, eps=10e-3):
+        super(PrioritizedReplayMemory, self).__init__(capacity, state_shape, state_dtype)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.eps = eps
+        self.priorities = SumTree(capacity)
+        self.max_priority = 1.0
+
+    def add(self, s, a, r, s2, done, discount):
+        # new transitions get the highest priority so they are replayed at least once soon
+        self.priorities.update(self.pos, self.max_priority)
+        super(PrioritizedReplayMemory, self).add(s, a, r, s2, done, discount)
+
+    def sample_indices(self, batch_sz):
+        # one value from each of batch_sz equal segments of the total priority
+        segment = self.priorities.total() / batch_sz
+        values = (np.arange(batch_sz) + np.random.rand(batch_sz)) * segment
+        idx = self.priorities.find(np.minimum(values, self.priorities.total() * (1 - 10e-9)))
+        return np.minimum(idx, self.size - 1)
+
+    def importance_weights(self, idx):
+        probs = self.priorities.get(idx) / self.priorities.total()
+        weights = (self.size * probs) ** -self.beta
+        self.beta = min(1.0, self.beta + self.beta_increment)
+        return (weights / weights.max()).astype(np.float32)
+
+    def update_priorities(self, idx, td_errors):
+        priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+        self.max_priority = max(self.max_priority, priorities.max())
+        # the last value written wins for duplicated indices, as with a single update
+        self.priorities.update(idx, priorities)
+
+class NStepWindow(object):
+    '''
+    Sliding window over the steps of an episode turning them into n-step transitions
+    (s_t, a_t, R_n, s_t+n, done, gamma^n) with R_n = r_t + gamma r_t+1 + ... + gamma^(n-1) r_t+n-1.
+    When the episode ends, the transitions still in the window are emitted with fewer rewards and done set.
+    '''
+    def __init__(self, n, gamma):
+        self.n = n
+        self.gamma = gamma
+        self.discounts = gamma ** np.arange(n + 1)
+        self.steps = deque()
+
+    def __len__(self):
+        return len(self.steps)
+
+    def append(self, s, a, r, s2, done):
+        # returns the list of transitions completed by this step
+        self.steps.append((s, a, r))
+        if done:
+            return [self.pop(s2, True) for _ in range(len(self.steps))]
+        elif len(self.steps) == self.n:
+            return [self.pop(s2, False)]
+        return []
+
+    def pop(self, s_n, done):
+        k = len(self.steps)
+        R = np.dot(self.discounts[:k], [r for _, _, r in self.steps])
+        s, a, _ = self.steps.popleft()
+        return s, a, R, s_n, done, self.discounts[k]
+
+    def clear(self):
+        self.steps.clear()
@@ -0,0 +1,308 @@
+import os
+import numpy as np
+from multiprocessing import shared_memory
+
+class QTable(object):
+    '''
+    Dense action-value table for worlds whose states are encoded as integers in [0, num_states).
+    It behaves like the {state: np.array(num_actions)} dictionaries used by the tabular agents
+    (s in Q, Q[s][a] = x, for s in Q) while keeping all rows in one contiguous array,
+    so batches of states can be read and updated with fancy indexing.
+    '''
+    def __init__(self, num_states, num_actions, fill=0.0, dtype=np.float64):
+        self.num_states = num_states
+        self.num_actions = num_actions
+        self.fill = fill
+        self.values = np.full((num_states, num_actions), fill, dtype=dtype)
+        self.visited = np.zeros(num_states, dtype=bool)
+
+    @classmethod
+    def from_arrays(cls, values, visited, fill=0.0):
+        Q = cls(0, values.shape[1], fill, values.dtype)
+        Q.num_states = values.shape[0]
+        Q.values = values
+        Q.visited = visited
+        return Q
+
+    @classmethod
+    def from_dict(cls, table, num_states, num_actions, fill=0.0):
+        Q = cls(num_states, num_actions, fill)
+        for s in table:
+            Q[s] = table[s]
+        return Q
+
+    def __contains__(self, s):
+        return self.visited[s]
+
+    def __getitem__(self, s):
+        # Row view, so Q[s][a] = x writes through to the table
+        return self.values[s]
+
+    def __setitem__(self, s, row):
+        self.values[s] = row
+        self.visited[s] = True
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self.visited))
+
+    def __len__(self):
+        return int(np.count_nonzero(self.visited))
+
+    def touch(self, states):
+        self.visited[states] = True
+
+class SharedQTable(QTable):
+    '''
+    QTable whose arrays live in multiprocessing.shared_memory blocks. Pickling it only passes the
+    block names, so every process gets a view of the same table.
+    '''
+    def __init__(self, num_states, num_actions, fill=0.0, dtype=np.float64, names=None):
+        self.num_states = num_states
+        self.num_actions = num_actions
+        self.fill = fill
+        self.dtype = np.dtype(dtype)
+        if names == None:
+            self._values_shm = shared_memory.SharedMemory(create=True, size=max(1, num_states * num_actions * self.dtype.itemsize))
+            self._visited_shm = shared_memory.SharedMemory(create=True, size=max(1, num_states))
+        else:
+            self._values_shm = shared_memory.SharedMemory(name=names[0])
+            self._visited_shm = shared_memory.SharedMemory(name=names[1])
+        self.values = np.ndarray((num_states, num_actions), dtype=self.dtype, buffer=self._values_shm.buf)
+        self.visited = np.ndarray(num_states, dtype=bool, buffer=self._visited_shm.buf)
+        if names == None:
+            self.values.fill(fill)
+            self.visited.fill(False)
+
+    @classmethod
+    def from_table(cls, Q):
+        shared = cls(Q.num_states, Q.num_actions, Q.fill, Q.values.dtype)
+        np.copyto(shared.values, Q.values)
+        np.copyto(shared.visited, Q.visited)
+        return shared
+
+    def __getstate__(self):
+        return (self.num_states, self.num_actions, self.fill, self.dtype.str, (self._values_shm.name, self._visited_shm.name))
+
+    def __setstate__(self, state):
+        num_states, num_actions, fill, dtype, names = state
+        self.__init__(num_states, num_actions, fill, dtype, names)
+
+    def release(self):
+        # Called once by the owner, the arrays are not usable afterwards
+        self.values = None
+        self.visited = None
+        self._values_shm.close()
+        self._values_shm.unlink()
+        self._visited_shm.close()
+        self._visited_shm.unlink()
+
+def epsilon_greedy(Q, states, eps, num_actions):
+    '''
+    Batched counterpart of the agents' choose_action. Returns the actions and the mask of random ones.
+    '''
+    explore = np.random.rand(len(states)) < eps
+    actions = np.argmax(Q.values[states], axis=1)
+    actions[explore] = np.random.randint(num_actions, size=np.count_nonzero(explore))
+    return actions, explore
+
+def td_update(Q, update_counts, states, actions, targets, alpha, count_step=0.005):
+    '''
+    Applies a batch of TD updates Q(s,a) += alpha / N(s,a) * (target - Q(s,a)).
+    A state-action pair that occurs several times in the batch is updated once with the mean
+    TD error of its occurrences: with fancy indexing only the last write would survive and
+    summing the errors would overshoot for large alpha.
+    '''
+    q = Q.values.reshape(-1)
+    counts = update_counts.values.reshape(-1)
+    sa = states * Q.num_actions + actions
+    pairs, inverse, occurrences = np.unique(sa, return_inverse=True, return_counts=True)
+    delta = np.bincount(inverse, weights=targets - q[sa]) / occurrences
+    q[pairs] += alpha / counts[pairs] * delta
+    counts[pairs] += count_step * occurrences
+    update_counts.touch(states)
+
+def update_traces(Q, update_counts, traces, delta, alpha, decay, cutoff, cut=False):
+    '''
+    Applies Q(s,a) += alpha / N(s,a) * delta * e(s,a) to the pairs of a {(s, a): eligibility} dictionary
+    and decays their traces by decay. Traces below cutoff are dropped, all of them with cut, as
+    Watkins's Q(lambda) does after an exploratory action.
+    '''
+    for sa in list(traces):
+        s, a = sa
+        Q[s][a] += alpha / update_counts[s][a] * delta * traces[sa]
+        e = traces[sa] * decay
+        if cut or e < cutoff:
+            del traces[sa]
+        else:
+            traces[sa] = e
+
+class PolicyTable(object):
+    '''
+    Dense counterpart of the {state: action} policy dictionaries, actions are stored as int8.
+    '''
+    def __init__(self, num_states, policy=None, visited=None):
+        self.policy = np.zeros(num_states, dtype=np.int8) if policy is None else policy
+        self.visited = np.zeros(num_states, dtype=bool) if visited is None else visited
+
+    def __contains__(self, s):
+        return self.visited[s]
+
+    def __getitem__(self, s):
+        return self.policy[s]
+
+    def __setitem__(self, s, a):
+        self.policy[s] = a
+        self.visited[s] = True
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self.visited))
+
+    def __len__(self):
+        return int(np.count_nonzero(self.visited))
+
+'''
+Binary tables format. All numbers are little endian.
+    header: magic 'RLTB', format version, number of arrays
+    one entry per array: name, dtype, number of dimensions, shape, offset of the data from the file start
+    data of every array, contiguous and aligned to TABLES_ALIGNMENT bytes
+'''
+TABLES_MAGIC = b'RLTB'
+TABLES_VERSION = 1
+TABLES_ALIGNMENT = 64
+TABLES_COPY_ROWS = 1 << 20
+TABLES_HEADER = np.dtype([('magic', 'S4'), ('version', '<u4'), ('num_arrays', '<u4')])
+TABLES_ENTRY = np.dtype([('name', 'S16'), ('dtype', 'S8'), ('ndim', '<u4'), ('shape', '<u8', (2,)), ('offset', '<u8')])
+
+def _aligned(offset):
+    return (offset + TABLES_ALIGNMENT - 1) // TABLES_ALIGNMENT * TABLES_ALIGNMENT
+
+def is_tables_file(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read(len(TABLES_MAGIC)) == TABLES_MAGIC
+
+def _write_layout(f, specs):
+    # Writes header and array entries for a list of (name, dtype, shape), returns entries and the file size
+    header = np.zeros(1, dtype=TABLES_HEADER)
+    header['magic'] = TABLES_MAGIC
+    header['version'] = TABLES_VERSION
+    header['num_arrays'] = len(specs)
+    entries = np.zeros(len(specs), dtype=TABLES_ENTRY)
+    offset = _aligned(TABLES_HEADER.itemsize + TABLES_ENTRY.itemsize * len(specs))
+    for i, (name, dtype, shape) in enumerate(specs):
+        dtype = np.dtype(dtype)
+        if len(shape) not in (1, 2):
+            raise RuntimeError("Array %s has %d dimensions, only 1 or 2 are supported" % (name, len(shape)))
+        entries[i]['name'] = name.encode('ascii')
+        entries[i]['dtype'] = dtype.newbyteorder('<').str.encode('ascii')
+        entries[i]['ndim'] = len(shape)
+        entries[i]['shape'][:len(shape)] = shape
+        entries[i]['offset'] = offset
+        offset = _aligned(offset + int(np.prod(shape)) * dtype.itemsize)
+
+    f.write(header.tobytes())
+    f.write(entries.tobytes())
+    return entries, offset
+
+def save_tables(file_name, arrays):
+    '''
+    Writes a list of (name, array) pairs, arrays must have one or two dimensions.
+    '''
+    with open(file_name, 'wb') as f:
+        entries, size = _write_layout(f, [(name, array.dtype, array.shape) for name, array in arrays])
+        for i, (name, array) in enumerate(arrays):
+            f.seek(int(entries[i]['offset']))
+            dtype = entries[i]['dtype'].decode('ascii')
+            # copy by blocks, so memory mapped tables larger than RAM can be saved as well
+            for start in range(0, len(array), TABLES_COPY_ROWS):
+                f.write(np.ascontiguousarray(array[start:start + TABLES_COPY_ROWS], dtype=dtype).tobytes())
+        f.truncate(size)
+
+def create_tables(file_name, specs):
+    '''
+    Creates a zero filled tables file for a list of (name, dtype, shape) and maps it for writing.
+    The data is not written, so on most file systems it doesn't take disk space until it's used.
+    '''
+    with open(file_name, 'wb') as f:
+        _, size = _write_layout(f, specs)
+        f.truncate(size)
+    return open_tables(file_name, mode='r+')
+
+def open_or_create_tables(file_name, specs, description="tables"):
+    '''
+    Reopens file_name for writing if it holds exactly the arrays of specs, a list of (name, dtype, shape),
+    creates it with create_tables() if it doesn't exist. An existing file is never overwritten, any other
+    content raises. Returns the {name: array} dictionary and whether the file was created.
+    '''
+    if not os.path.exists(file_name):
+        return create_tables(file_name, specs), True
+    if not is_tables_file(file_name):
+        raise RuntimeError("%s exists and is not a %s file" % (file_name, description))
+    arrays = open_tables(file_name, mode='r+')
+    for name, dtype, shape in specs:
+        if name not in arrays:
+            raise RuntimeError("%s %s has no %s array, it can't be reopened" % (description.capitalize(), file_name, name))
+        if arrays[name].dtype != np.dtype(dtype) or arrays[name].shape != tuple(shape):
+            raise RuntimeError("%s %s has %s of type %s and shape %s, %s and %s expected"
+                               % (description.capitalize(), file_name, name, arrays[name].dtype, arrays[name].shape, np.dtype(dtype), tuple(shape)))
+    return arrays, False
+
+def open_tables(file_name, mode='c'):
+    '''
+    Maps every array of the file with np.memmap and returns a {name: array} dictionary.
+    With the default copy-on-write mode pages are shared between processes until somebody writes to them.
+    '''
+    with open(file_name, 'rb') as f:
+        header = np.frombuffer(f.read(TABLES_HEADER.itemsize), dtype=TABLES_HEADER)[0]
+        if header['magic'] != TABLES_MAGIC:
+            raise RuntimeError("%s is not a tables file" % file_name)
+        if header['version'] != TABLES_VERSION:
+            raise RuntimeError("Unsupported tables format version %d in %s" % (header['version'], file_name))
+        entries = np.frombuffer(f.read(TABLES_ENTRY.itemsize * header['num_arrays']), dtype=TABLES_ENTRY)
+
+    arrays = {}
+    for entry in entries:
+        shape = tuple(int(d) for d in entry['shape'][:entry['ndim']])
+        arrays[entry['name'].decode('ascii')] = np.memmap(file_name, dtype=entry['dtype'].decode('ascii'), mode=mode, offset=int(entry['offset']), shape=shape)
+    return arrays
+
+def save_q_tables(file_name, Q, update_counts=None, num_states=None, num_actions=None, env_descriptor=None):
+    '''
+    Saves a Q table (QTable or {int state: values} dictionary) together with its greedy policy.
+    A dictionary only holds the visited states, so num_states and num_actions of the world should be
+    given, directly or by the agent's env_descriptor, otherwise the loaded table ends at the largest visited state.
+    '''
+    if num_states == None and env_descriptor != None:
+        num_states, num_actions = env_descriptor.num_states, env_descriptor.num_actions
+    if not isinstance(Q, QTable):
+        if not all(isinstance(s, (int, np.integer)) for s in Q):
+            raise RuntimeError("Only Q tables of integer encoded states can be saved")
+        if num_states == None:
+            num_states = max(Q) + 1 if len(Q) > 0 else 0
+        elif len(Q) > 0 and max(Q) >= num_states:
+            raise RuntimeError("Q table has state %d, but the world has %d states" % (max(Q), num_states))
+        if num_actions == None:
+            num_actions = len(Q[next(iter(Q))]) if len(Q) > 0 else 0
+        if num_states == 0 or num_actions == 0:
+            raise RuntimeError("Empty Q table can't be saved without num_states and num_actions")
+        Q = QTable.from_dict(Q, num_states, num_actions)
+        if update_counts != None:
+            update_counts = QTable.from_dict(update_counts, num_states, num_actions, fill=1.0)
+
+    arrays = [('Q', Q.values), ('visited', Q.visited), ('policy', np.argmax(Q.values, axis=1).astype(np.int8))]
+    if update_counts != None:
+        arrays += [('counts', update_counts.values), ('counts_visited', update_counts.visited)]
+    save_tables(file_name, arrays)
+
+def load_q_tables(file_name, mode='c'):
+    '''
+    Opens tables written by save_q_tables. Returns Q and update counts (fresh ones if they weren't saved)
+    as memory mapped QTables and the greedy policy as a PolicyTable.
+    '''
+    arrays = open_tables(file_name, mode)
+    Q = QTable.from_arrays(arrays['Q'], arrays['visited'])
+    if 'counts' in arrays:
+        update_counts = QTable.from_arrays(arrays['counts'], arrays['counts_visited'], fill=1.0)
+    else:
+        update_counts = QTable(Q.num_states, Q.num_actions, fill=1.0)
+    policy = PolicyTable(Q.num_states, arrays['policy'], arrays['visited'])
+    return Q, update_counts, policy
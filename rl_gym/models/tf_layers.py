@@ -31,4 +31,29 @@ class HiddenLayer:
             a = tf.matmul(X, self.W) + self.b
         else:
             a = tf.matmul(X, self.W)
-        return self.f(a)
\ No newline at end of file
+        return self.f(a)
+
+def create_session(graph, intra_op_threads=0, inter_op_threads=0):
+    '''
+    Session of its own for the graph, thread pool sizes of 0 let TensorFlow use all the cores.
+    Agents training side by side in one process should split the cores between them.
+    '''
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads, inter_op_parallelism_threads=inter_op_threads)
+    return tf.Session(graph=graph, config=config)
+
+def create_models_session(models, intra_op_threads=0, inter_op_threads=0):
+    '''
+    Creates the session of an agent, initializes the variables of its models and sets the session of each.
+    The agent owns the graph of its models, build them in a fresh tf.Graph() to keep several agents
+    of one process apart. Returns the graph and the session.
+    '''
+    graph = models[0].graph
+    if any(model.graph is not graph for model in models):
+        raise RuntimeError("Models of an agent must be built in the same graph")
+    with graph.as_default():
+        init = tf.global_variables_initializer()
+    session = create_session(graph, intra_op_threads, inter_op_threads)
+    session.run(init)
+    for model in models:
+        model.set_session(session)
+    return graph, session
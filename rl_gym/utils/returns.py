@@ -0,0 +1,40 @@
+import numpy as np
+
+def discounted_returns(rewards, dones, gamma, bootstrap=None):
+    '''
+    Solves G_t = r_t + gamma * (1 - done_t) * G_t+1 for trajectories of shape (T,) or (T, num_envs),
+    G_T being bootstrap (0 by default). A done step ends its episode, so a trajectory can hold several.
+    A single trajectory is stepped over Python floats, which beats numpy calls on every step,
+    several ones a vectorized step for all environments at a time.
+    '''
+    rewards = np.asarray(rewards, dtype=np.float64)
+    discounts = gamma * (1.0 - np.asarray(dones, dtype=np.float64))
+    next_G = np.zeros(rewards.shape[1:]) if bootstrap is None else np.asarray(bootstrap, dtype=np.float64)
+    if rewards.ndim == 1:
+        G = rewards.tolist()
+        discounts = discounts.tolist()
+        g = float(next_G)
+        for t in reversed(range(len(G))):
+            g = G[t] + discounts[t] * g
+            G[t] = g
+        return np.array(G, dtype=np.float64)
+    G = np.empty_like(rewards)
+    for t in reversed(range(len(rewards))):
+        next_G = rewards[t] + discounts[t] * next_G
+        G[t] = next_G
+    return G
+
+def generalized_advantages(rewards, values, dones, gamma, lambda_=0.95, last_values=None):
+    '''
+    GAE(lambda) of trajectories of shape (T,) or (T, num_envs): values are V(s_t) and last_values the
+    values of the states following the last step (0 by default). Returns advantages and the
+    value targets advantages + values. lambda_ = 0 gives one step TD errors, lambda_ = 1 n-step
+    returns bootstrapped from last_values.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    last_values = np.zeros(values.shape[1:]) if last_values is None else np.asarray(last_values, dtype=np.float64)
+    not_done = 1.0 - np.asarray(dones, dtype=np.float64)
+    next_values = np.concatenate([values[1:], last_values[None]])
+    deltas = np.asarray(rewards, dtype=np.float64) + gamma * not_done * next_values - values
+    advantages = discounted_returns(deltas, dones, gamma * lambda_)
+    return advantages, advantages + values
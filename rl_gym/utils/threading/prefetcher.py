@@ -0,0 +1,50 @@
+from threading import Thread, Event
+from queue import Queue, Full, Empty
+
+class BatchPrefetcher(object):
+    '''
+    Daemon thread calling make_batch() ahead of time and keeping up to depth batches ready,
+    so the consumer only waits when it is faster than the batch preparation.
+    An exception raised by make_batch() stops the thread and is raised by every following next(),
+    once the batches made before it are consumed.
+    '''
+    def __init__(self, make_batch, depth=2, name="prefetcher"):
+        self.make_batch = make_batch
+        self.queue = Queue(depth)
+        self.stop_event = Event()
+        self.error = None
+        self.thread = Thread(target=self.run, name=name)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                batch = self.make_batch()
+            except Exception as e:
+                self.error = e
+                return
+            # don't block forever on a full queue once the consumer is gone
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except Full:
+                    pass
+
+    def next(self):
+        # a thread which failed or was stopped won't put more batches, don't wait for them forever
+        while True:
+            try:
+                return self.queue.get(timeout=0.1)
+            except Empty:
+                if self.error != None:
+                    raise self.error
+                if not self.thread.is_alive():
+                    raise RuntimeError("%s thread isn't running" % self.thread.name)
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()